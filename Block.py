@@ -1,41 +1,31 @@
 import streamlit as st
-import hashlib
-import json
 import datetime
 import pandas as pd
-import os
 import base64
-import random
 from typing import Optional
 
-# File to store the blockchain
-BLOCKCHAIN_FILE = "blockchain_data.json"
+import chain_store
 
 # Supported file types
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'doc', 'docx'}
 IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
-# Initialize session state
-if 'blockchain' not in st.session_state:
-    st.session_state.blockchain = []
-
 # --- File Handling Functions ---
 def is_allowed_file(filename: str, file_types: set) -> bool:
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in file_types
 
-def save_uploaded_file(uploaded_file, file_types: set) -> Optional[str]:
-    """Save uploaded file and return base64 encoded content"""
+def save_uploaded_file(uploaded_file, file_types: set) -> Optional[dict]:
+    """Save uploaded file to the blob store and return its digest and size"""
     if uploaded_file is not None and is_allowed_file(uploaded_file.name, file_types):
-        file_content = uploaded_file.getvalue()
-        return base64.b64encode(file_content).decode('utf-8')
+        return chain_store.put_blob(uploaded_file.getvalue())
     return None
 
-def display_document(file_data: str, file_name: str):
+def display_document(file_data, file_name: str):
     """Display document based on its type"""
     if not file_data:
         return
 
-    decoded = base64.b64decode(file_data)
+    decoded = chain_store.payload_bytes(file_data)
     file_ext = file_name.split('.')[-1].lower()
 
     if file_ext == 'pdf':
@@ -53,41 +43,8 @@ def display_document(file_data: str, file_name: str):
         )
 
 # --- Blockchain Functions ---
-def load_blockchain():
-    if os.path.exists(BLOCKCHAIN_FILE):
-        with open(BLOCKCHAIN_FILE, 'r') as f:
-            return json.load(f)
-    return []
-
-def save_blockchain(blockchain):
-    with open(BLOCKCHAIN_FILE, 'w') as f:
-        json.dump(blockchain, f, indent=2)
-
-def calculate_hash(block):
-    block_string = json.dumps(block, sort_keys=True).encode()
-    return hashlib.sha256(block_string).hexdigest()
-
-def create_block(data, previous_hash=''):
-    block = {
-        'index': len(st.session_state.blockchain) + 1,
-        'timestamp': str(datetime.datetime.now()),
-        'data': data,
-        'previous_hash': previous_hash,
-        'hash': '',
-        'unique_id': f"{random.randint(10**11, 10**12 - 1):012d}"  # 12-digit ID
-    }
-    block['hash'] = calculate_hash(block)
-    return block
-
 def add_block(data):
-    previous_hash = st.session_state.blockchain[-1]['hash'] if st.session_state.blockchain else ''
-    new_block = create_block(data, previous_hash)
-    st.session_state.blockchain.append(new_block)
-    save_blockchain(st.session_state.blockchain)
-    return new_block['unique_id']
-
-# Initialize blockchain
-st.session_state.blockchain = load_blockchain()
+    return chain_store.register_document(data)
 
 # --- Streamlit UI ---
 st.title("📄🔗 Document Verification Blockchain")
@@ -175,11 +132,7 @@ elif menu == "Verify Document":
         if not unique_id.isdigit() or len(unique_id) != 12:
             st.error("Please enter a valid 12-digit number")
         else:
-            matching_block = None
-            for block in st.session_state.blockchain:
-                if block.get('unique_id') == unique_id:
-                    matching_block = block
-                    break
+            matching_block = chain_store.find_block(chain_store.open_store(), unique_id)
 
             if matching_block:
                 data = matching_block['data']
@@ -188,7 +141,7 @@ elif menu == "Verify Document":
                 with col1:
                     if data.get('identity_photo'):
                         st.subheader("Identity Verification")
-                        st.image(base64.b64decode(data['identity_photo']), 
+                        st.image(chain_store.payload_bytes(data['identity_photo']), 
                                 caption=f"Photo of {data['owner_name']}", 
                                 width=200)
                     else:
@@ -213,9 +166,10 @@ elif menu == "Verify Document":
 
                 st.subheader("Blockchain Verification")
                 st.write(f"**Block Hash:** {matching_block['hash']}")
-                calculated_hash = calculate_hash(matching_block)
+                if matching_block.get('batch'):
+                    st.write(f"**Merkle Root:** {matching_block['batch']['block']['data']['merkle_root']}")
 
-                if calculated_hash == matching_block['hash']:
+                if chain_store.verify_record(matching_block):
                     st.success("✅ Document verified - This record has not been tampered with")
                 else:
                     st.error("❌ Verification failed - This document may have been altered")
@@ -225,45 +179,69 @@ elif menu == "Verify Document":
 elif menu == "View Blockchain":
     st.header("Blockchain Explorer")
 
-    if st.session_state.blockchain:
-        st.write(f"Total blocks in chain: {len(st.session_state.blockchain)}")
-
-        view_option = st.radio("View Options", ["All Records", "Search by Document Type"])
-
-        if view_option == "All Records":
-            simplified_blocks = []
-            for block in st.session_state.blockchain:
-                simplified_blocks.append({
-                    "Unique ID": block['unique_id'],
-                    "Type": block['data']['record_type'],
-                    "Owner": block['data']['owner_name'],
-                    "Date": block['timestamp'],
-                    "File": block['data']['file_name']
-                })
-            st.dataframe(pd.DataFrame(simplified_blocks))
-
-        elif view_option == "Search by Document Type":
-            doc_type = st.selectbox("Select Document Type",
-                                  ["Educational Certificate",
-                                   "Professional License",
-                                   "Property Document",
-                                   "Government ID",
-                                   "Legal Contract",
-                                   "Other"])
-
-            filtered_blocks = [block for block in st.session_state.blockchain
-                             if block['data']['record_type'] == doc_type]
-
-            if filtered_blocks:
-                st.write(f"Found {len(filtered_blocks)} {doc_type} records")
-                for block in filtered_blocks:
-                    with st.expander(f"ID: {block['unique_id']} - {block['data']['owner_name']}"):
-                        if block['data'].get('identity_photo'):
-                            st.image(base64.b64decode(block['data']['identity_photo']), 
-                                    caption="Identity Photo", 
-                                    width=150)
-                        st.json(block['data'])
-            else:
-                st.info(f"No {doc_type} records found")
+    block_count = chain_store.chain_length()
+    if block_count:
+        st.write(f"Total blocks in chain: {block_count}")
+
+        view_option = st.radio("View Options", ["All Records", "Search Records"])
+
+        filters = {}
+        if view_option == "Search Records":
+            col1, col2 = st.columns(2)
+            with col1:
+                doc_type = st.selectbox("Document Type",
+                                      ["Any",
+                                       "Educational Certificate",
+                                       "Professional License",
+                                       "Property Document",
+                                       "Government ID",
+                                       "Legal Contract",
+                                       "Other"])
+                owner_prefix = st.text_input("Owner Name Starts With")
+            with col2:
+                date_from = st.date_input("Registered From", value=None)
+                date_to = st.date_input("Registered To", value=None)
+            filters = {
+                "record_type": None if doc_type == "Any" else doc_type,
+                "owner_prefix": owner_prefix.strip() or None,
+                "date_from": date_from,
+                "date_to": date_to,
+            }
+
+        conn = chain_store.open_store()
+        total = chain_store.count_records(conn, **filters)
+
+        if total:
+            col1, col2, col3 = st.columns(3)
+            sort = col1.selectbox("Sort by", list(chain_store.RECORD_SORTS))
+            page_size = col2.selectbox("Rows per page", [25, 50, 100])
+            page_count = (total + page_size - 1) // page_size
+            page = col3.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1)
+
+            if filters:
+                st.write(f"Found {total} matching records")
+            # Only this page's headers are read; select a row to load its document
+            records = chain_store.list_records(conn, sort, (page - 1) * page_size, page_size, **filters)
+            simplified_blocks = [{
+                "Unique ID": record['unique_id'],
+                "Type": record['record_type'],
+                "Owner": record['owner_name'],
+                "Date": record['timestamp'],
+                "File": record['file_name']
+            } for record in records]
+            selection = st.dataframe(pd.DataFrame(simplified_blocks), hide_index=True,
+                                     on_select="rerun", selection_mode="single-row")
+
+            selected = [row for row in selection.selection.rows if row < len(records)]
+            if selected:
+                block = chain_store.find_block(conn, records[selected[0]]['unique_id'])
+                st.subheader(f"ID: {block['unique_id']} - {block['data']['owner_name']}")
+                if block['data'].get('identity_photo'):
+                    st.image(chain_store.payload_bytes(block['data']['identity_photo']),
+                            caption="Identity Photo",
+                            width=150)
+                st.json(block['data'])
+        else:
+            st.info("No matching records found" if filters else "No documents found")
     else:
         st.info("The blockchain is currently empty. No documents have been registered yet.")
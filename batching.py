@@ -0,0 +1,42 @@
+# Batching helpers shared by the TB tools and the document chain
+#
+# next_batch() is the grouping step of a single consumer thread: it blocks for one
+# request, then takes whatever else arrives within max_wait seconds (tb_server's
+# micro-batcher, chain_store's Merkle batch writer). bounded_results() runs a
+# function over a stream of argument tuples in an executor with at most `depth`
+# calls in flight, so feeding a million rows never queues a million futures
+# (tb_batch's decoders, chain_import's blob hashing).
+
+import queue
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+def next_batch(requests, max_size, max_wait):
+    """Wait for one item from `requests`, then collect up to max_size arriving within max_wait seconds"""
+    batch = [requests.get()]
+    deadline = time.perf_counter() + max_wait
+    while len(batch) < max_size:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(requests.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def bounded_results(pool, fn, arguments, depth):
+    """Yield fn(*args) for each tuple in `arguments`, in completion order, with at most depth calls pending"""
+    arguments = iter(arguments)
+    pending = set()
+    while True:
+        while len(pending) < depth:
+            args = next(arguments, None)
+            if args is None:
+                break
+            pending.add(pool.submit(fn, *args))
+        if not pending:
+            return
+        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            yield future.result()
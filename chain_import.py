@@ -0,0 +1,201 @@
+# Bulk registration of archived documents into the Block.py chain
+# Run: python chain_import.py manifest.csv --files archive/ -o imported_ids.csv
+#      python chain_import.py manifest.csv --files archive/ --batch-size 5000 --workers 8
+#
+# The manifest is a CSV with one document per row: "file" (path under --files),
+# "owner_name" and "record_type" are required; "identity_photo" (path under
+# --files), "registration_date" and "additional_notes" are optional, and any other
+# column (institution, degree, year, ...) is kept as a document detail like the
+# registration form does. registration_date must be an ISO date (YYYY-MM-DD, a
+# time part is dropped); rows with a bad date, an empty required column or more
+# fields than the header are reported and skipped. Files are hashed into the blob
+# store in a process pool and blocks are committed --batch-size at a time. Each
+# transaction also records a fingerprint of every row it registered (its cleaned,
+# non-empty fields), so running the manifest again - after an interruption, a
+# fixed row or appended rows - skips exactly the rows already in the chain.
+
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import batching
+import chain_store
+
+REQUIRED_COLUMNS = ["file", "owner_name", "record_type"]
+# Manifest columns that are not copied into the document as details
+RESERVED_COLUMNS = {"file", "owner_name", "record_type", "identity_photo", "registration_date", "additional_notes"}
+
+def read_manifest(manifest):
+    with open(manifest, newline='') as f:
+        reader = csv.DictReader(f)
+        missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"{manifest} is missing columns: {', '.join(missing)}")
+        # Row numbers count data rows from 1 and identify a row across runs
+        for number, row in enumerate(reader, start=1):
+            yield number, row
+
+def clean_row(row):
+    # Raises ValueError for a row that cannot be registered as is
+    if None in row:
+        raise ValueError(f"{len(row[None])} more fields than the header")
+    empty = [column for column in REQUIRED_COLUMNS if not row.get(column)]
+    if empty:
+        raise ValueError(f"empty {', '.join(empty)}")
+    if row.get('registration_date'):
+        try:
+            date = datetime.datetime.fromisoformat(row['registration_date'].strip()).date()
+        except ValueError:
+            raise ValueError(f"registration_date {row['registration_date']!r} is not an ISO date (YYYY-MM-DD)")
+        row = {**row, 'registration_date': date.isoformat()}
+    return row
+
+def row_fingerprint(row):
+    # Identifies a cleaned row whatever its position, path or blank columns in the manifest
+    fields = {key: value for key, value in row.items() if value}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+def imported_id(conn, fingerprint):
+    row = conn.execute("SELECT unique_id FROM imported_rows WHERE fingerprint = ?", (fingerprint,)).fetchone()
+    return row[0] if row else None
+
+def manifest_rows(manifest, errors):
+    # (number, cleaned row, fingerprint) for each valid row; invalid ones go to errors
+    for number, row in read_manifest(manifest):
+        try:
+            row = clean_row(row)
+        except ValueError as e:
+            errors.append((number, f"ValueError: {e}"))
+            continue
+        yield number, row, row_fingerprint(row)
+
+def store_files(number, row, fingerprint, files, blob_dir):
+    # Runs in a worker process: hash and copy the row's files into the blob store
+    try:
+        content = chain_store.put_blob_file(os.path.join(files, row['file']), blob_dir)
+        photo = None
+        if row.get('identity_photo'):
+            photo = chain_store.put_blob_file(os.path.join(files, row['identity_photo']), blob_dir)
+        return number, row, fingerprint, content, photo, None
+    except Exception as e:
+        return number, row, fingerprint, None, None, f"{type(e).__name__}: {e}"
+
+def document_data(row, content, photo):
+    # Same fields as the Register Document form
+    file_name = os.path.basename(row['file'])
+    return {
+        "record_type": row['record_type'],
+        "owner_name": row['owner_name'],
+        "file_name": file_name,
+        "file_content": content,
+        "identity_photo": photo,
+        "file_type": file_name.split('.')[-1].lower(),
+        "registration_date": row.get('registration_date') or str(datetime.date.today()),
+        "additional_notes": row.get('additional_notes', ''),
+        **{key: value for key, value in row.items() if key not in RESERVED_COLUMNS and value},
+    }
+
+def import_manifest(manifest, files, db, blob_dir, batch_size, workers, queue_depth):
+    conn = chain_store.open_store(db)
+    imported = 0
+    skipped = 0
+    hashed_bytes = 0
+    errors = []
+
+    def new_rows():
+        nonlocal skipped
+        for number, row, fingerprint in manifest_rows(manifest, errors):
+            if imported_id(conn, fingerprint) is None:
+                yield number, row, fingerprint, files, blob_dir
+            else:
+                skipped += 1
+
+    started = time.perf_counter()
+    batch = []
+
+    def flush():
+        nonlocal imported, skipped
+        with chain_store.write_transaction(conn):
+            # A row repeated in the manifest reaches here once per copy; register the first
+            fresh = {}
+            for fingerprint, data in batch:
+                if fingerprint not in fresh and imported_id(conn, fingerprint) is None:
+                    fresh[fingerprint] = data
+            skipped += len(batch) - len(fresh)
+            batch[:] = fresh.items()
+            blocks = chain_store.append_blocks(conn, [data for _, data in batch])
+            conn.executemany("INSERT INTO imported_rows (fingerprint, unique_id) VALUES (?, ?)",
+                             [(fingerprint, block['unique_id']) for (fingerprint, _), block in zip(batch, blocks)])
+        imported += len(batch)
+        batch.clear()
+        elapsed = time.perf_counter() - started
+        print(f"\rImported {imported} documents ({imported / elapsed:.1f} docs/s, "
+              f"{hashed_bytes / elapsed / 1e6:.1f} MB/s hashed)", end='', file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = batching.bounded_results(pool, store_files, new_rows(), queue_depth)
+        for number, row, fingerprint, content, photo, error in results:
+            if error is not None:
+                # Not recorded as imported, so the next run retries the row
+                errors.append((number, error))
+                continue
+            hashed_bytes += content['size'] + (photo['size'] if photo else 0)
+            batch.append((fingerprint, document_data(row, content, photo)))
+            if len(batch) == batch_size:
+                flush()
+        if batch:
+            flush()
+    if imported:
+        print(file=sys.stderr)
+    if skipped:
+        print(f"Skipped {skipped} rows already imported", file=sys.stderr)
+    for number, error in sorted(errors):
+        print(f"Row {number}: {error}", file=sys.stderr)
+    return imported, hashed_bytes, errors
+
+def write_ids(conn, manifest, output):
+    # Every row of this manifest imported so far, in manifest order
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["row", "unique_id"])
+        for number, _, fingerprint in manifest_rows(manifest, []):
+            unique_id = imported_id(conn, fingerprint)
+            if unique_id is not None:
+                writer.writerow([number, unique_id])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Register a CSV manifest of documents in the chain")
+    parser.add_argument("manifest", help="CSV with file, owner_name, record_type and optional detail columns")
+    parser.add_argument("--files", default=".", help="folder the manifest's file paths are relative to")
+    parser.add_argument("-o", "--output", help="write row -> unique_id for the manifest here")
+    parser.add_argument("--db", default=chain_store.BLOCKCHAIN_DB)
+    parser.add_argument("--blobs", default=chain_store.BLOB_DIR)
+    parser.add_argument("--batch-size", type=int, default=1000, help="blocks committed per transaction")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--queue-depth", type=int, default=None,
+                        help="max rows hashed ahead of the writer (default: 2 batches)")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    imported, hashed_bytes, errors = import_manifest(args.manifest, args.files, args.db, args.blobs,
+                                                     max(1, args.batch_size), args.workers,
+                                                     args.queue_depth or 2 * args.batch_size)
+    elapsed = time.perf_counter() - started
+    print(f"Imported {imported} new documents ({hashed_bytes / 1e6:.1f} MB) in {elapsed:.1f}s "
+          f"({imported / elapsed if elapsed else 0:.1f} docs/s)", file=sys.stderr)
+
+    if args.output:
+        write_ids(chain_store.connect(args.db), args.manifest, args.output)
+        print(f"Wrote {args.output}", file=sys.stderr)
+    if errors:
+        print(f"{len(errors)} rows failed; fix them and run again to register just those rows", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,690 @@
+# Block store for the document blockchain in Block.py
+# Run: python chain_store.py migrate blockchain_data.json
+#      python chain_store.py audit [--full]
+#
+# Blocks live in one SQLite table: header fields (index, hashes, unique_id,
+# record type, owner, file name, dates) are plain columns and the document
+# payload is a JSON column that is only read when a single block is opened.
+# Appending writes one row, and the app loads headers only. An empty store
+# imports the legacy blockchain_data.json the first time it is opened.
+# Document IDs are looked up through an index on unique_id. Uploaded files are
+# kept out of the chain in a content-addressed blob directory; a block stores
+# {"sha256": ..., "size": ...} for each, so identical uploads share one file.
+# The explorer pages through `records`, a header index of every document
+# (batched or not) kept in chain order, and reads a payload only for the row
+# that is opened. Indexes on record type, owner name (case-insensitive) and
+# registration date serve the explorer's combined searches.
+# Nothing keeps the chain in memory: chain_length() is one lookup on the
+# primary key, cached per process until the store's generation counter moves.
+# `audit` re-hashes blocks and checks previous_hash links across worker
+# processes, then writes an HMAC-signed checkpoint so the next audit starts
+# after it; run it with --full now and then to re-check the whole chain.
+# Every write runs under BEGIN IMMEDIATE on a WAL database: appenders in any
+# session or process take turns on the chain head, and readers never block.
+# With CHAIN_BATCH_INTERVAL set, registrations are queued and sealed into one
+# block per interval whose data is the Merkle root of the batch; each document
+# row keeps its inclusion proof, so verifying one document is O(log n).
+
+import hashlib
+import hmac
+import json
+import datetime
+import base64
+import os
+import queue
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Optional
+
+import batching
+
+BLOCKCHAIN_DB = "blockchain.db"
+# Legacy single-file chain, imported into the store on first use
+BLOCKCHAIN_FILE = "blockchain_data.json"
+# Uploaded documents and photos, stored once per SHA-256 as blobs/<2 hex>/<64 hex>
+BLOB_DIR = "blobs"
+
+# HMAC key for audit checkpoints; set CHAIN_AUDIT_KEY to keep it away from the store,
+# otherwise a random key is generated into CHAIN_AUDIT_KEY_FILE on first use
+AUDIT_KEY_FILE = os.environ.get("CHAIN_AUDIT_KEY_FILE", "chain_audit.key")
+AUDIT_CHUNK_SIZE = 5000
+
+# Seconds a writer waits for another process or session to finish its commit
+BUSY_TIMEOUT = float(os.environ.get("CHAIN_BUSY_TIMEOUT", "30"))
+
+# Seconds a registration waits for others to join its block; 0 writes one block per document
+BATCH_INTERVAL = float(os.environ.get("CHAIN_BATCH_INTERVAL", "0"))
+BATCH_MAX_SIZE = int(os.environ.get("CHAIN_BATCH_MAX_SIZE", "1000"))
+BATCH_RECORD_TYPE = "Merkle Batch"
+
+# Explorer sort orders, applied in SQL before paging
+RECORD_SORTS = {
+    "Newest first": "id DESC",
+    "Oldest first": "id",
+    "Owner name": "owner_name COLLATE NOCASE, id",
+    "Registration date": "registration_date DESC, id DESC",
+}
+RECORD_COLUMNS = ["unique_id", "idx", "position", "timestamp",
+                  "record_type", "owner_name", "file_name", "registration_date"]
+
+# Columns read when the app loads the chain; the payload column is only read per block
+HEADER_COLUMNS = ["idx", "unique_id", "timestamp", "hash", "previous_hash",
+                  "record_type", "owner_name", "file_name", "registration_date"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    idx INTEGER PRIMARY KEY,
+    unique_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    previous_hash TEXT NOT NULL,
+    record_type TEXT,
+    owner_name TEXT,
+    file_name TEXT,
+    registration_date TEXT,
+    data TEXT NOT NULL
+);
+-- unique_id -> block; maintained by SQLite on every insert, and rebuilt here if it was dropped
+CREATE INDEX IF NOT EXISTS blocks_unique_id ON blocks (unique_id);
+-- generation is bumped in the same transaction as every insert
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+-- Documents sealed in a Merkle batch block; proof is the sibling path from the leaf to the block's root
+CREATE TABLE IF NOT EXISTS documents (
+    unique_id TEXT PRIMARY KEY,
+    idx INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    record_type TEXT,
+    owner_name TEXT,
+    file_name TEXT,
+    registration_date TEXT,
+    data TEXT NOT NULL,
+    proof TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_block ON documents (idx, position);
+-- Header index of every registered document, own block or batched, in chain order (id)
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    unique_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    record_type TEXT,
+    owner_name TEXT,
+    file_name TEXT,
+    registration_date TEXT
+);
+-- Secondary indexes for explorer searches. Each leads with one filter and carries the
+-- other two, so combined filters and counts are answered from the index alone.
+CREATE INDEX IF NOT EXISTS records_record_type
+    ON records (record_type, registration_date, owner_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS records_owner_name
+    ON records (owner_name COLLATE NOCASE, record_type, registration_date);
+CREATE INDEX IF NOT EXISTS records_registration_date
+    ON records (registration_date, record_type, owner_name COLLATE NOCASE);
+-- Manifest rows already registered by chain_import.py, by fingerprint, committed with their blocks
+CREATE TABLE IF NOT EXISTS imported_rows (
+    fingerprint TEXT PRIMARY KEY,
+    unique_id TEXT NOT NULL
+);
+-- Each row says blocks 1..idx verified clean when it was written, and that block idx had this hash
+CREATE TABLE IF NOT EXISTS checkpoints (
+    idx INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL,
+    created TEXT NOT NULL,
+    signature TEXT NOT NULL
+);
+"""
+
+_local = threading.local()
+
+# Shared header list per store path, reused by every session in the process
+# path -> (generation, length)
+_lengths = {}
+# Stores whose schema this process has already checked
+_prepared = set()
+
+# --- Connection ---
+def connect(path: str = BLOCKCHAIN_DB) -> sqlite3.Connection:
+    """Return this thread's connection to the store, creating the schema if needed"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        if path not in _prepared:
+            prepare_store(conn)
+            _prepared.add(path)
+        connections[path] = conn
+    return conn
+
+def prepare_store(conn: sqlite3.Connection):
+    """Create missing tables and seed the generation counter, writing only when something is missing
+
+    CREATE ... IF NOT EXISTS on an existing table reads the schema without locking,
+    so opening an up-to-date store never waits on (or blocks) an appender."""
+    # WAL: readers keep reading the last commit while a writer appends
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != 'wal':
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'generation'").fetchone() is None:
+        with write_transaction(conn):
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)")
+    if (conn.execute("SELECT 1 FROM records LIMIT 1").fetchone() is None
+            and conn.execute("SELECT 1 FROM blocks LIMIT 1").fetchone() is not None):
+        rebuild_records(conn)
+
+def rebuild_records(conn: sqlite3.Connection):
+    """Refill the header index from blocks and batched documents, for stores written before it existed"""
+    columns = ', '.join(RECORD_COLUMNS)
+    with write_transaction(conn):
+        conn.execute("DELETE FROM records")
+        conn.execute(f"""INSERT INTO records ({columns})
+            SELECT {columns} FROM (
+                SELECT unique_id, idx, 0 AS position, timestamp, record_type, owner_name, file_name, registration_date
+                FROM blocks WHERE record_type IS NOT ?
+                UNION ALL
+                SELECT unique_id, idx, position, timestamp, record_type, owner_name, file_name, registration_date
+                FROM documents)
+            ORDER BY idx, position""", (BATCH_RECORD_TYPE,))
+
+@contextmanager
+def write_transaction(conn: sqlite3.Connection):
+    """Hold the store's single write lock from reading the chain head until commit
+
+    BEGIN IMMEDIATE takes SQLite's file lock up front, so two appenders (threads or
+    processes) can never both build on the same head; the second waits up to
+    BUSY_TIMEOUT and then sees the first one's block."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+# --- Blobs ---
+def blob_path(digest: str, blob_dir: str = BLOB_DIR) -> str:
+    return os.path.join(blob_dir, digest[:2], digest)
+
+def put_blob(content: bytes, blob_dir: str = BLOB_DIR) -> dict:
+    """Store content under its SHA-256 unless it is already there; return the reference kept in the block"""
+    digest = hashlib.sha256(content).hexdigest()
+    path = blob_path(digest, blob_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write aside and rename so a reader never sees a partial blob
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    return {'sha256': digest, 'size': len(content)}
+
+def put_blob_file(file_path: str, blob_dir: str = BLOB_DIR, chunk_size: int = 1 << 20) -> dict:
+    """put_blob for a file on disk, hashed and copied in chunks so large files never sit in memory"""
+    os.makedirs(blob_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=blob_dir)
+    try:
+        with open(file_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            while chunk := src.read(chunk_size):
+                digest.update(chunk)
+                dst.write(chunk)
+                size += len(chunk)
+        path = blob_path(digest.hexdigest(), blob_dir)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return {'sha256': digest.hexdigest(), 'size': size}
+
+def open_blob(ref: dict, blob_dir: str = BLOB_DIR):
+    """Binary file object for a blob reference"""
+    return open(blob_path(ref['sha256'], blob_dir), 'rb')
+
+def payload_bytes(value, blob_dir: str = BLOB_DIR) -> Optional[bytes]:
+    """Bytes of a stored file: a blob reference, or base64 text in blocks written before the blob store"""
+    if not value:
+        return None
+    if isinstance(value, dict):
+        with open_blob(value, blob_dir) as f:
+            return f.read()
+    return base64.b64decode(value)
+
+# --- Blocks ---
+def calculate_hash(block: dict) -> str:
+    block_string = json.dumps(block, sort_keys=True).encode()
+    return hashlib.sha256(block_string).hexdigest()
+
+def block_hash(block: dict) -> str:
+    """Hash a block the way create_block sealed it, with its own hash field blank"""
+    return calculate_hash({**block, 'hash': ''})
+
+def create_block(index: int, data: dict, previous_hash: str = '', unique_id: Optional[str] = None) -> dict:
+    block = {
+        'index': index,
+        'timestamp': str(datetime.datetime.now()),
+        'data': data,
+        'previous_hash': previous_hash,
+        'hash': '',
+        'unique_id': unique_id or f"{random.randint(10**11, 10**12 - 1):012d}"  # 12-digit ID
+    }
+    block['hash'] = calculate_hash(block)
+    return block
+
+def _block_row(block: dict) -> tuple:
+    data = block['data']
+    return (block['index'], block['unique_id'], block['timestamp'], block['hash'], block['previous_hash'],
+            data.get('record_type'), data.get('owner_name'), data.get('file_name'),
+            data.get('registration_date'), json.dumps(data))
+
+def _insert_blocks(conn: sqlite3.Connection, blocks: list):
+    conn.executemany(f"INSERT INTO blocks ({', '.join(HEADER_COLUMNS)}, data) "
+                     f"VALUES ({', '.join('?' * (len(HEADER_COLUMNS) + 1))})",
+                     [_block_row(block) for block in blocks])
+    _insert_records(conn, [(block['unique_id'], block['index'], 0, block['timestamp'], block['data'])
+                           for block in blocks if block['data'].get('record_type') != BATCH_RECORD_TYPE])
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+def _insert_records(conn: sqlite3.Connection, records: list):
+    # records: (unique_id, block index, position in block, timestamp, document data)
+    conn.executemany(f"INSERT INTO records ({', '.join(RECORD_COLUMNS)}) VALUES ({', '.join('?' * len(RECORD_COLUMNS))})",
+                     [(unique_id, index, position, timestamp, data.get('record_type'), data.get('owner_name'),
+                       data.get('file_name'), data.get('registration_date'))
+                      for unique_id, index, position, timestamp, data in records])
+
+def append_blocks(conn: sqlite3.Connection, datas: list) -> list:
+    """Chain one block per document onto the head; call inside write_transaction"""
+    last = conn.execute("SELECT idx, hash FROM blocks ORDER BY idx DESC LIMIT 1").fetchone()
+    index, previous_hash = (last['idx'] + 1, last['hash']) if last else (1, '')
+    taken = set()
+    blocks = []
+    for data in datas:
+        unique_id = _unused_id(conn, taken)
+        taken.add(unique_id)
+        blocks.append(create_block(index, data, previous_hash, unique_id))
+        index, previous_hash = index + 1, blocks[-1]['hash']
+    _insert_blocks(conn, blocks)
+    return blocks
+
+def append_block(conn: sqlite3.Connection, data: dict) -> dict:
+    """Append one block; only the new row is written"""
+    with write_transaction(conn):
+        return append_blocks(conn, [data])[0]
+
+def _header(row: sqlite3.Row) -> dict:
+    header = dict(row)
+    header['index'] = header.pop('idx')
+    return header
+
+def chain_generation(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+def chain_length(path: str = BLOCKCHAIN_DB) -> int:
+    """Number of blocks in the chain, re-read only when the store's generation moves"""
+    conn = open_store(path)
+    generation = chain_generation(conn)
+    cached = _lengths.get(path)
+    if cached is None or cached[0] != generation:
+        cached = _lengths[path] = (generation, conn.execute("SELECT MAX(idx) FROM blocks").fetchone()[0] or 0)
+    return cached[1]
+
+def _block(row: sqlite3.Row) -> dict:
+    return {
+        'index': row['idx'],
+        'timestamp': row['timestamp'],
+        'data': json.loads(row['data']),
+        'previous_hash': row['previous_hash'],
+        'hash': row['hash'],
+        'unique_id': row['unique_id'],
+    }
+
+def get_block(conn: sqlite3.Connection, index: int) -> Optional[dict]:
+    """Full block, payload included, in the same shape it was created with"""
+    row = conn.execute("SELECT * FROM blocks WHERE idx = ?", (index,)).fetchone()
+    return _block(row) if row else None
+
+def find_block(conn: sqlite3.Connection, unique_id: str) -> Optional[dict]:
+    """Full record for a document ID, looked up through the unique_id indexes
+
+    A document sealed in a batch comes back shaped like its own block, with the
+    sealing block and the document's inclusion proof under 'batch'."""
+    # A batch-sealing block's ID is not a document ID
+    row = conn.execute("SELECT * FROM blocks WHERE unique_id = ? AND record_type IS NOT ? ORDER BY idx LIMIT 1",
+                       (unique_id, BATCH_RECORD_TYPE)).fetchone()
+    if row:
+        return _block(row)
+    row = conn.execute("SELECT * FROM documents WHERE unique_id = ?", (unique_id,)).fetchone()
+    if row is None:
+        return None
+    block = get_block(conn, row['idx'])
+    document = _document(row)
+    return {
+        **document,
+        'index': block['index'],
+        'previous_hash': block['previous_hash'],
+        'hash': block['hash'],
+        'batch': {'block': block, 'proof': json.loads(row['proof'])},
+    }
+
+def _record_filter(record_type: Optional[str] = None, owner_prefix: Optional[str] = None,
+                   date_from: Optional[str] = None, date_to: Optional[str] = None) -> tuple:
+    # Each condition can be answered by one of the records indexes; dates are ISO strings
+    conditions, params = [], []
+    if record_type:
+        conditions.append("record_type = ?")
+        params.append(record_type)
+    if owner_prefix:
+        # Case-insensitive prefix as a NOCASE range, so the owner_name index is used
+        conditions.append("owner_name >= ? COLLATE NOCASE AND owner_name < ? COLLATE NOCASE")
+        params += [owner_prefix, owner_prefix + "\U0010ffff"]
+    if date_from:
+        conditions.append("registration_date >= ?")
+        params.append(str(date_from))
+    if date_to:
+        conditions.append("registration_date <= ?")
+        params.append(str(date_to))
+    return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+def count_records(conn: sqlite3.Connection, **filters) -> int:
+    where, params = _record_filter(**filters)
+    if not where:
+        # Records are never deleted, so ids run 1..count
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM records").fetchone()[0]
+    return conn.execute(f"SELECT COUNT(*) FROM records {where}", params).fetchone()[0]
+
+def list_records(conn: sqlite3.Connection, sort: str, offset: int, limit: int, **filters) -> list:
+    """One page of document headers matching record_type, owner_prefix and a registration date range
+
+    Payloads stay on disk until find_block is called for a row."""
+    where, params = _record_filter(**filters)
+    rows = conn.execute(f"SELECT * FROM records {where} ORDER BY {RECORD_SORTS[sort]} LIMIT ? OFFSET ?",
+                        params + [limit, offset])
+    return [_header(row) for row in rows]
+
+def verify_record(record: dict) -> bool:
+    """Check a record from find_block against its block hash, and its Merkle proof if it was batched"""
+    batch = record.get('batch')
+    if batch is None:
+        return block_hash(record) == record['hash']
+    block = batch['block']
+    return (block_hash(block) == block['hash']
+            and merkle_root_from_proof(document_leaf(record), batch['proof']) == block['data']['merkle_root'])
+
+# --- Merkle batches ---
+def document_leaf(document: dict) -> str:
+    return calculate_hash({key: document[key] for key in ('unique_id', 'timestamp', 'data')})
+
+def _merkle_parent(left: str, right: str) -> str:
+    return hashlib.sha256((left + right).encode()).hexdigest()
+
+def merkle_levels(leaves: list) -> list:
+    """Every level of the tree from the leaves up; an odd node is paired with itself"""
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([_merkle_parent(level[i], level[min(i + 1, len(level) - 1)])
+                       for i in range(0, len(level), 2)])
+    return levels
+
+def merkle_proof(levels: list, position: int) -> list:
+    proof = []
+    for level in levels[:-1]:
+        sibling = position ^ 1
+        proof.append([level[min(sibling, len(level) - 1)], 'right' if sibling > position else 'left'])
+        position //= 2
+    return proof
+
+def merkle_root_from_proof(leaf: str, proof: list) -> str:
+    node = leaf
+    for sibling, side in proof:
+        node = _merkle_parent(node, sibling) if side == 'right' else _merkle_parent(sibling, node)
+    return node
+
+def _document(row: sqlite3.Row) -> dict:
+    return {'unique_id': row['unique_id'], 'timestamp': row['timestamp'], 'data': json.loads(row['data'])}
+
+def _unused_id(conn: sqlite3.Connection, taken: set) -> str:
+    while True:
+        unique_id = f"{random.randint(10**11, 10**12 - 1):012d}"
+        if (unique_id not in taken
+                and not conn.execute("SELECT 1 FROM blocks WHERE unique_id = ?", (unique_id,)).fetchone()
+                and not conn.execute("SELECT 1 FROM documents WHERE unique_id = ?", (unique_id,)).fetchone()):
+            return unique_id
+
+def seal_batch(conn: sqlite3.Connection, documents: list) -> list:
+    """Write queued document data as one block committing to their Merkle root; return their IDs"""
+    with write_transaction(conn):
+        taken = set()
+        sealed = []
+        for data, timestamp in documents:
+            unique_id = _unused_id(conn, taken)
+            taken.add(unique_id)
+            sealed.append({'unique_id': unique_id, 'timestamp': timestamp, 'data': data})
+        levels = merkle_levels([document_leaf(document) for document in sealed])
+
+        last = conn.execute("SELECT idx, hash FROM blocks ORDER BY idx DESC LIMIT 1").fetchone()
+        index, previous_hash = (last['idx'] + 1, last['hash']) if last else (1, '')
+        block = create_block(index, {'record_type': BATCH_RECORD_TYPE, 'merkle_root': levels[-1][0],
+                                     'document_count': len(sealed)}, previous_hash, _unused_id(conn, taken))
+        _insert_blocks(conn, [block])
+        conn.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (document['unique_id'], index, position, document['timestamp'],
+             document['data'].get('record_type'), document['data'].get('owner_name'),
+             document['data'].get('file_name'), document['data'].get('registration_date'),
+             json.dumps(document['data']), json.dumps(merkle_proof(levels, position)))
+            for position, document in enumerate(sealed)])
+        _insert_records(conn, [(document['unique_id'], index, position, document['timestamp'], document['data'])
+                               for position, document in enumerate(sealed)])
+    return [document['unique_id'] for document in sealed]
+
+class BatchWriter:
+    # Collects registrations for up to `interval` seconds and seals them into one block
+    def __init__(self, path, interval, max_size):
+        self.path = path
+        self.interval = interval
+        self.max_size = max(1, max_size)
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, name="chain-batcher", daemon=True).start()
+
+    def submit(self, data):
+        request = {"data": data, "timestamp": str(datetime.datetime.now()), "done": threading.Event()}
+        self.queue.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["unique_id"]
+
+    def _run(self):
+        conn = connect(self.path)
+        while True:
+            batch = batching.next_batch(self.queue, self.max_size, self.interval)
+            try:
+                for request, unique_id in zip(batch, seal_batch(conn, [(r["data"], r["timestamp"]) for r in batch])):
+                    request["unique_id"] = unique_id
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            for request in batch:
+                request["done"].set()
+
+_batch_writers = {}
+_batch_writers_lock = threading.Lock()
+
+def batch_writer(path: str = BLOCKCHAIN_DB) -> BatchWriter:
+    """The process-wide writer for a store, started on first use"""
+    with _batch_writers_lock:
+        if path not in _batch_writers:
+            _batch_writers[path] = BatchWriter(path, BATCH_INTERVAL, BATCH_MAX_SIZE)
+        return _batch_writers[path]
+
+def register_document(data: dict, path: str = BLOCKCHAIN_DB) -> str:
+    """Record one document and return its unique ID, batched when CHAIN_BATCH_INTERVAL is set"""
+    if BATCH_INTERVAL > 0:
+        return batch_writer(path).submit(data)
+    return append_block(open_store(path), data)['unique_id']
+
+# --- Audit ---
+def audit_key() -> bytes:
+    key = os.environ.get("CHAIN_AUDIT_KEY")
+    if key:
+        return key.encode()
+    if not os.path.exists(AUDIT_KEY_FILE):
+        fd = os.open(AUDIT_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(32).hex())
+    with open(AUDIT_KEY_FILE) as f:
+        return f.read().strip().encode()
+
+def checkpoint_signature(key: bytes, index: int, hash_: str, created: str) -> str:
+    return hmac.new(key, f"{index}:{hash_}:{created}".encode(), hashlib.sha256).hexdigest()
+
+def _audit_range(path: str, first: int, last: int) -> list:
+    # Runs in a worker process: re-hash blocks first..last and check each link to its predecessor
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("SELECT hash FROM blocks WHERE idx = ?", (first - 1,)).fetchone()
+    previous_hash = row['hash'] if row else ''
+    failures = []
+    expected = first
+    for row in conn.execute("SELECT * FROM blocks WHERE idx BETWEEN ? AND ? ORDER BY idx", (first, last)):
+        block = _block(row)
+        if block['index'] != expected:
+            failures.append({'index': expected, 'error': f"blocks {expected}..{block['index'] - 1} are missing"})
+        elif block['previous_hash'] != previous_hash:
+            failures.append({'index': block['index'], 'error': "previous_hash does not match the preceding block"})
+        if block_hash(block) != block['hash']:
+            failures.append({'index': block['index'], 'error': "hash does not match the block contents"})
+        if block['data'].get('record_type') == BATCH_RECORD_TYPE:
+            leaves = [document_leaf(_document(document)) for document in
+                      conn.execute("SELECT * FROM documents WHERE idx = ? ORDER BY position", (block['index'],))]
+            if not leaves or merkle_levels(leaves)[-1][0] != block['data']['merkle_root']:
+                failures.append({'index': block['index'], 'error': "batched documents do not match the Merkle root"})
+        previous_hash = block['hash']
+        expected = block['index'] + 1
+    if expected <= last:
+        failures.append({'index': expected, 'error': f"blocks {expected}..{last} are missing"})
+    conn.close()
+    return failures
+
+def check_checkpoints(conn: sqlite3.Connection, key: bytes) -> tuple:
+    """Compare every checkpoint with the chain; return the newest one to resume from, and any disagreements
+
+    A checkpoint that is badly signed, points past the chain head, or whose block no
+    longer has the signed hash is evidence of tampering, so it is reported and nothing
+    is trusted: the audit then starts from the genesis block."""
+    head = conn.execute("SELECT MAX(idx) FROM blocks").fetchone()[0] or 0
+    failures = []
+    latest = None
+    for row in conn.execute("SELECT * FROM checkpoints ORDER BY idx DESC"):
+        if not hmac.compare_digest(row['signature'], checkpoint_signature(key, row['idx'], row['hash'], row['created'])):
+            failures.append({'index': row['idx'], 'error': "checkpoint signature is invalid"})
+            continue
+        block = conn.execute("SELECT hash FROM blocks WHERE idx = ?", (row['idx'],)).fetchone()
+        if block is None:
+            failures.append({'index': row['idx'],
+                             'error': f"checkpoint signed at {row['created']} is past the chain head ({head})"})
+        elif block['hash'] != row['hash']:
+            failures.append({'index': row['idx'],
+                             'error': f"block hash differs from the one signed at {row['created']}"})
+        elif latest is None:
+            latest = dict(row)
+    return (None if failures else latest), failures
+
+def audit_chain(path: str = BLOCKCHAIN_DB, full: bool = False, workers: Optional[int] = None,
+                chunk_size: int = AUDIT_CHUNK_SIZE) -> dict:
+    """Verify every block hash and previous_hash link, in parallel, from the last signed checkpoint
+
+    A clean run records a new checkpoint at the chain head. Blocks at or below a
+    checkpoint are trusted on later runs as long as every checkpoint still agrees
+    with the chain; full=True re-verifies from the genesis block regardless.
+    Existing checkpoints are never rewritten, so disagreeing ones stay as evidence."""
+    key = audit_key()
+    conn = connect(path)
+    head = conn.execute("SELECT MAX(idx) FROM blocks").fetchone()[0] or 0
+    checkpoint, failures = check_checkpoints(conn, key)
+    if full:
+        checkpoint = None
+    first = checkpoint['idx'] + 1 if checkpoint else 1
+
+    started = time.perf_counter()
+    ranges = [(start, min(start + chunk_size - 1, head)) for start in range(first, head + 1, chunk_size)]
+    if ranges:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chunk in pool.map(_audit_range, [path] * len(ranges), *zip(*ranges)):
+                failures.extend(chunk)
+
+    report = {
+        'head': head,
+        'resumed_from_checkpoint': checkpoint['idx'] if checkpoint else None,
+        'blocks_checked': max(0, head - first + 1),
+        'seconds': round(time.perf_counter() - started, 3),
+        'failures': failures,
+        'checkpoint': None,
+    }
+    if not failures and head and head >= first:
+        row = conn.execute("SELECT hash FROM blocks WHERE idx = ?", (head,)).fetchone()
+        created = str(datetime.datetime.now())
+        with write_transaction(conn):
+            # A checkpoint already at the head agreed with the chain above; keep the original
+            inserted = conn.execute("INSERT OR IGNORE INTO checkpoints (idx, hash, created, signature) "
+                                    "VALUES (?, ?, ?, ?)",
+                                    (head, row['hash'], created, checkpoint_signature(key, head, row['hash'], created)))
+        if inserted.rowcount:
+            report['checkpoint'] = head
+    return report
+
+# --- Migration ---
+def migrate_json(conn: sqlite3.Connection, json_path: str = BLOCKCHAIN_FILE) -> int:
+    """Copy blocks from the legacy JSON chain into the store, skipping ones already there"""
+    with open(json_path, 'r') as f:
+        blockchain = json.load(f)
+    with write_transaction(conn):
+        existing = {row[0] for row in conn.execute("SELECT idx FROM blocks")}
+        new_blocks = [block for block in blockchain if block['index'] not in existing]
+        _insert_blocks(conn, new_blocks)
+    return len(new_blocks)
+
+def open_store(path: str = BLOCKCHAIN_DB, legacy_path: str = BLOCKCHAIN_FILE) -> sqlite3.Connection:
+    """Connect, importing the legacy JSON chain the first time an empty store is opened"""
+    conn = connect(path)
+    if os.path.exists(legacy_path) and conn.execute("SELECT 1 FROM blocks LIMIT 1").fetchone() is None:
+        migrate_json(conn, legacy_path)
+    return conn
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Maintain the document blockchain store")
+    parser.add_argument("--db", default=BLOCKCHAIN_DB)
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="import a legacy blockchain_data.json")
+    migrate_parser.add_argument("json_path", nargs="?", default=BLOCKCHAIN_FILE)
+    audit_parser = commands.add_parser("audit", help="verify every hash and link since the last checkpoint")
+    audit_parser.add_argument("--full", action="store_true", help="ignore checkpoints and verify from the first block")
+    audit_parser.add_argument("--workers", type=int, default=None)
+    audit_parser.add_argument("--chunk-size", type=int, default=AUDIT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        count = migrate_json(connect(args.db), args.json_path)
+        print(f"Imported {count} blocks from {args.json_path} into {args.db}", file=sys.stderr)
+    elif args.command == "audit":
+        report = audit_chain(args.db, args.full, args.workers, args.chunk_size)
+        print(json.dumps(report, indent=2))
+        if report['failures']:
+            print(f"{len(report['failures'])} problems found in {args.db}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,798 @@
 import streamlit as st
 import onnxruntime
 import numpy as np
+import pandas as pd
 from PIL import Image
-import torchvision.transforms as transforms
+import io
+import os
+import json
 import time
+import uuid
+import hashlib
+import logging
+import sqlite3
+import threading
+import contextvars
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
-def load_onnx_model(model_path):
-    session = onnxruntime.InferenceSession(model_path)
-    return session
+MODEL_PATH = "resnet.onnx"
+IMAGE_SIZE = 512
+CLASS_NAMES = ["Normal", "Tuberculosis"]
+NORMALIZE_MEAN = 0.485
+NORMALIZE_STD = 0.229
+MAX_BATCH_SIZE = int(os.environ.get("TB_MAX_BATCH_SIZE", "16"))
+INFERENCE_WORKERS = int(os.environ.get("TB_INFERENCE_WORKERS", "2"))
+
+# Uploads are checked against these limits from the file header alone, before any
+# pixels are decoded; accepted images are decoded once with the longest side capped
+# at DECODE_SIZE and that copy feeds both the preview and the model
+MAX_UPLOAD_BYTES = int(os.environ.get("TB_MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.environ.get("TB_MAX_IMAGE_PIXELS", str(8000 * 8000)))
+DECODE_SIZE = int(os.environ.get("TB_DECODE_SIZE", "1024"))
+UPLOAD_TYPES = ["jpg", "jpeg", "png", "dcm", "dicom"]
+
+# A film is called Tuberculosis when its TB probability reaches the threshold; films
+# within the margin of it are flagged as uncertain for rescreening
+DECISION_THRESHOLD = float(os.environ.get("TB_THRESHOLD", "0.5"))
+UNCERTAIN_MARGIN = float(os.environ.get("TB_UNCERTAIN_MARGIN", "0.15"))
+
+# Tiled mode splits a film into a TILE_GRID x TILE_GRID grid of overlapping tiles,
+# each scored at IMAGE_SIZE, and combines the tile scores with TILE_AGGREGATE
+TILE_GRID = int(os.environ.get("TB_TILE_GRID", "3"))
+TILE_OVERLAP = float(os.environ.get("TB_TILE_OVERLAP", "0.25"))
+TILE_AGGREGATE = os.environ.get("TB_TILE_AGGREGATE", "mean")
+
+# Test-time augmentation scores the first TTA_VIEWS of these views in one batch and
+# averages them: ("crop", fraction, x, y) keeps `fraction` of each side anchored at
+# relative position (x, y); ("shift", gain, offset) adjusts intensity in [0, 1] space
+TTA_VIEWS = int(os.environ.get("TB_TTA_VIEWS", "8"))
+TTA_RECIPES = [
+    ("identity",),
+    ("flip",),
+    ("crop", 0.9, 0.5, 0.5),
+    ("shift", 1.0, 0.05),
+    ("shift", 1.0, -0.05),
+    ("crop", 0.9, 0.0, 0.0),
+    ("crop", 0.9, 1.0, 1.0),
+    ("shift", 1.1, -0.05),
+]
+
+# Which build of the model to serve; quantized variants are produced by tb_quantize.py
+# and live next to the FP32 model as e.g. resnet.int8.onnx
+MODEL_VARIANT = os.environ.get("TB_MODEL_VARIANT", "fp32")
+MODEL_VARIANTS = ["fp32", "int8", "int8-static", "fp16"]
+
+# When set, the UI is a thin client of tb_server.py and loads no model of its own
+SERVER_URL = os.environ.get("TB_SERVER_URL", "")
+SERVER_TIMEOUT = float(os.environ.get("TB_SERVER_TIMEOUT", "60"))
+
+# Result cache: in-memory LRU, plus an optional SQLite tier when a path is set
+RESULT_CACHE_SIZE = int(os.environ.get("TB_RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_PATH = os.environ.get("TB_RESULT_CACHE_PATH", "")
+RESULT_CACHE_DISK_SIZE = int(os.environ.get("TB_RESULT_CACHE_DISK_SIZE", "100000"))
+
+# Timing spans are written as JSON lines to a rotating log when a path is set;
+# onnxruntime profiler traces requested from the debug panel go to PROFILE_DIR
+TIMING_LOG_PATH = os.environ.get("TB_TIMING_LOG", "")
+TIMING_LOG_BYTES = int(os.environ.get("TB_TIMING_LOG_BYTES", str(5 * 1024 * 1024)))
+TIMING_LOG_BACKUPS = int(os.environ.get("TB_TIMING_LOG_BACKUPS", "3"))
+PROFILE_DIR = os.environ.get("TB_PROFILE_DIR", "profiles")
+
+# Session tuning; 0 lets onnxruntime pick the thread counts
+INTRA_OP_THREADS = int(os.environ.get("TB_INTRA_OP_THREADS", "0"))
+INTER_OP_THREADS = int(os.environ.get("TB_INTER_OP_THREADS", "0"))
+GRAPH_OPT_LEVEL = os.environ.get("TB_GRAPH_OPT_LEVEL", "all")
+
+GRAPH_OPT_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# Process-wide session registry, shared by every Streamlit session and rerun
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+_model_digests = {}
+
+_results = OrderedDict()
+_results_lock = threading.Lock()
+_results_db = None
+
+# Spans recorded in the current request; copied into worker threads with the context
+_span_sink = contextvars.ContextVar("tb_span_sink", default=None)
+_span_request = contextvars.ContextVar("tb_span_request", default=None)
+_timing_logger = None
+_timing_lock = threading.Lock()
+
+# Classification runs here so Streamlit script threads only poll for progress
+_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="tb-inference")
+
+def timing_logger():
+    global _timing_logger
+    with _timing_lock:
+        if _timing_logger is None:
+            logger = logging.getLogger("tb.timings")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handler = RotatingFileHandler(TIMING_LOG_PATH, maxBytes=TIMING_LOG_BYTES,
+                                          backupCount=TIMING_LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            _timing_logger = logger
+    return _timing_logger
+
+def start_spans():
+    spans = []
+    _span_sink.set(spans)
+    _span_request.set(uuid.uuid4().hex[:12])
+    return spans
+
+def record_span(stage, start, **fields):
+    span = {"stage": stage, "ms": round((time.perf_counter() - start) * 1000, 3), **fields}
+    spans = _span_sink.get()
+    if spans is not None:
+        spans.append(span)
+    if TIMING_LOG_PATH:
+        timing_logger().info(json.dumps({"time": time.time(), "request": _span_request.get(),
+                                         "thread": threading.current_thread().name, **span}))
+
+@contextmanager
+def timed(stage, **fields):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, start, **fields)
 
-def preprocess_image(image):
-    transform = transforms.Compose([
-        transforms.Resize((512, 512)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485], std=[0.229])
-    ])
-    image = transform(image)
+class ImageRejected(ValueError):
+    pass
+
+# What PIL raises for a truncated, corrupt or oversized file. DecompressionBombError
+# (a header claiming over twice Image.MAX_IMAGE_PIXELS) is a plain Exception.
+DECODE_ERRORS = (OSError, SyntaxError, ValueError, Image.DecompressionBombError)
+
+def check_image(image, nbytes):
+    if nbytes > MAX_UPLOAD_BYTES:
+        raise ImageRejected(f"file is {nbytes / 1e6:.1f} MB, the limit is {MAX_UPLOAD_BYTES / 1e6:.0f} MB")
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageRejected(f"image is {width}x{height}, the limit is {MAX_IMAGE_PIXELS / 1e6:.0f} megapixels")
+
+class DicomImage:
+    # Header-only handle on a DICOM file or upload; pixels are read by decode_dicom.
+    # `source` is a path (pixels can be memory-mapped) or the uploaded bytes.
+    def __init__(self, source, header):
+        self.source = source
+        self.header = header
+        self.size = (int(header.Columns), int(header.Rows))
+        self.width, self.height = self.size
+
+def is_dicom(prefix):
+    # Part 10 files carry "DICM" after a 128-byte preamble
+    return prefix[128:132] == b"DICM"
+
+def read_dicom_header(source):
+    try:
+        import pydicom
+    except ImportError as e:
+        raise ImageRejected("DICOM support needs pydicom (pip install pydicom)") from e
+    fp = io.BytesIO(source) if isinstance(source, bytes) else source
+    try:
+        return DicomImage(source, pydicom.dcmread(fp, stop_before_pixels=True))
+    except Exception as e:
+        raise ImageRejected(f"not a readable DICOM file: {e}") from e
+
+def dicom_pixels(image, step):
+    # Uncompressed single-frame files on disk are memory-mapped, and the stride means
+    # only every step-th row is paged in; everything else goes through pixel_array
+    import pydicom
+    header = image.header
+    syntax = header.file_meta.TransferSyntaxUID
+    if (isinstance(image.source, str) and not syntax.is_compressed
+            and int(header.get("NumberOfFrames", 1) or 1) == 1 and int(header.get("SamplesPerPixel", 1)) == 1
+            and header.BitsAllocated in (8, 16)):
+        element = pydicom.dcmread(image.source, defer_size=1024).get_item("PixelData", keep_deferred=True)
+        dtype = np.dtype(("<" if syntax.is_little_endian else ">")
+                         + ("i" if header.PixelRepresentation else "u") + str(header.BitsAllocated // 8))
+        pixels = np.memmap(image.source, dtype=dtype, mode="r", offset=element.value_tell,
+                           shape=(image.height, image.width))
+    else:
+        fp = io.BytesIO(image.source) if isinstance(image.source, bytes) else image.source
+        pixels = pydicom.dcmread(fp).pixel_array
+        if int(header.get("NumberOfFrames", 1) or 1) > 1:
+            pixels = pixels[0]
+        if pixels.ndim == 3:
+            pixels = pixels.mean(axis=2)
+    return np.asarray(pixels[::step, ::step], dtype=np.float32)
+
+def window_dicom(pixels, header):
+    # Modality rescale, then the stored VOI window (or the full range) mapped to 8 bits
+    pixels = pixels * float(header.get("RescaleSlope", 1) or 1) + float(header.get("RescaleIntercept", 0) or 0)
+    center, width = header.get("WindowCenter"), header.get("WindowWidth")
+    if center is not None and width is not None:
+        # Multi-valued windows list alternatives; the first is the default
+        center, width = float(np.atleast_1d(center)[0]), float(np.atleast_1d(width)[0])
+        low, high = center - width / 2, center + width / 2
+    else:
+        low, high = float(pixels.min()), float(pixels.max())
+    scaled = np.clip((pixels - low) / max(high - low, 1e-6), 0, 1)
+    if header.get("PhotometricInterpretation") == "MONOCHROME1":
+        scaled = 1 - scaled
+    return (scaled * 255).astype(np.uint8)
+
+def decode_dicom(image, size):
+    try:
+        step = max(1, min(image.width, image.height) // size)
+        decoded = Image.fromarray(window_dicom(dicom_pixels(image, step), image.header), "L")
+    except Exception as e:
+        raise ImageRejected(f"could not decode DICOM pixels: {e}") from e
+    decoded.thumbnail((size, size))
+    return decoded
+
+def open_image_file(path):
+    with open(path, 'rb') as f:
+        prefix = f.read(132)
+    if is_dicom(prefix):
+        return read_dicom_header(path)
+    try:
+        return Image.open(path)
+    except DECODE_ERRORS as e:
+        raise ImageRejected(f"not a readable image: {e}") from e
+
+def open_upload(payload):
+    # Image.open and the DICOM reader only parse the header; nothing is decoded yet
+    if len(payload) > MAX_UPLOAD_BYTES:
+        raise ImageRejected(f"file is {len(payload) / 1e6:.1f} MB, the limit is {MAX_UPLOAD_BYTES / 1e6:.0f} MB")
+    if is_dicom(payload[:132]):
+        image = read_dicom_header(payload)
+    else:
+        try:
+            image = Image.open(io.BytesIO(payload))
+        except DECODE_ERRORS as e:
+            raise ImageRejected(f"not a readable image: {e}") from e
+    check_image(image, len(payload))
     return image
 
-def classify_image_onnx(image, session):
-    processed_image = preprocess_image(image)
-    
-    processed_image = processed_image.unsqueeze(0)
+def decode_reduced(image, mode, size=DECODE_SIZE):
+    # JPEGs decode straight at a reduced DCT scale; other formats are decoded and
+    # shrunk once, so later stages never touch the full-resolution pixels
+    if isinstance(image, DicomImage):
+        return decode_dicom(image, size).convert(mode)
+    try:
+        image.draft(mode, (size, size))
+        image.thumbnail((size, size))
+        return image.convert(mode)
+    except DECODE_ERRORS as e:
+        raise ImageRejected(f"could not decode image: {e}") from e
+
+def create_session_options(intra_op_threads, inter_op_threads, graph_opt_level):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.graph_optimization_level = GRAPH_OPT_LEVELS[graph_opt_level]
+    return options
+
+def model_channels(session):
+    channels = session.get_inputs()[0].shape[1]
+    return channels if isinstance(channels, int) else 1
 
-    input_data = processed_image.numpy()
+def model_batch_limit(session, max_batch_size):
+    # Models exported with a fixed batch dimension can't take larger batches
+    batch = session.get_inputs()[0].shape[0]
+    return min(batch, max_batch_size) if isinstance(batch, int) else max_batch_size
 
+def warmup_session(session):
+    # Run one dummy image so the first real request doesn't pay for allocation
+    dummy = np.zeros((1, model_channels(session), IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+    input_name = session.get_inputs()[0].name
+    session.run(None, {input_name: dummy})
+
+def model_digest(model_path):
+    # SHA-256 of the model file, recomputed only when its size or mtime changes
+    stat = os.stat(model_path)
+    key = (os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns)
+    digest = _model_digests.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(model_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        _model_digests[key] = digest
+    return digest
+
+def variant_model_path(model_path, variant):
+    if variant == "fp32":
+        return model_path
+    stem, ext = os.path.splitext(model_path)
+    return f"{stem}.{variant}{ext}"
+
+def resolve_model_path(model_path, variant=None):
+    variant = variant or MODEL_VARIANT
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model variant {variant!r}, expected one of {MODEL_VARIANTS}")
+    path = variant_model_path(model_path, variant)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found; build it with: python tb_quantize.py build {variant}")
+    return path
+
+def load_onnx_model(model_path, intra_op_threads=None, inter_op_threads=None, graph_opt_level=None, warmup=True,
+                    variant=None):
+    model_path = resolve_model_path(model_path, variant)
+    if intra_op_threads is None:
+        intra_op_threads = INTRA_OP_THREADS
+    if inter_op_threads is None:
+        inter_op_threads = INTER_OP_THREADS
+    if graph_opt_level is None:
+        graph_opt_level = GRAPH_OPT_LEVEL
+    # The digest in the key makes a replaced model file load as a fresh session
+    key = (model_digest(model_path), intra_op_threads, inter_op_threads, graph_opt_level)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            options = create_session_options(intra_op_threads, inter_op_threads, graph_opt_level)
+            session = onnxruntime.InferenceSession(model_path, sess_options=options,
+                                                   providers=["CPUExecutionProvider"])
+            if warmup:
+                warmup_session(session)
+            _sessions[key] = session
+    return session
+
+def preprocess_image(image, out=None):
+    # PIL + NumPy equivalent of Resize -> ToTensor -> Normalize for 8-bit L/RGB images,
+    # writing the CHW float32 result into `out` when a buffer is supplied
+    start = time.perf_counter()
+    resized = image.resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR)
+    record_span("resize", start, width=image.width, height=image.height)
+
+    start = time.perf_counter()
+    pixels = np.asarray(resized)
+    pixels = pixels[np.newaxis] if pixels.ndim == 2 else pixels.transpose(2, 0, 1)
+    if out is None:
+        out = np.empty(pixels.shape, dtype=np.float32)
+    np.divide(pixels, 255.0, out=out, casting="unsafe")
+    out -= NORMALIZE_MEAN
+    out /= NORMALIZE_STD
+    record_span("normalize", start)
+    return out
+
+def softmax(logits):
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+def model_mode(session):
+    # All images must share the model's channel count to be stacked into one NCHW batch
+    return "L" if model_channels(session) == 1 else "RGB"
+
+def score_batch(input_data, session):
     input_name = session.get_inputs()[0].name
     output_name = session.get_outputs()[0].name
-    result = session.run([output_name], {input_name: input_data})[0]
+    with timed("session_run", batch=len(input_data)):
+        logits = session.run([output_name], {input_name: input_data})[0]
+    return softmax(logits)
+
+def label_scores(probabilities, threshold=None, margin=None):
+    # Thresholds a whole (N, classes) probability array at once; only building the
+    # per-film dicts is done row by row
+    threshold = DECISION_THRESHOLD if threshold is None else threshold
+    margin = UNCERTAIN_MARGIN if margin is None else margin
+    probabilities = np.asarray(probabilities, dtype=np.float32).reshape(-1, len(CLASS_NAMES))
+    tb = probabilities[:, CLASS_NAMES.index("Tuberculosis")]
+    positive = tb >= threshold
+    confidence = np.where(positive, tb, 1 - tb)
+    uncertain = np.abs(tb - threshold) < margin
+    return [{
+        "prediction": "Tuberculosis" if is_positive else "Normal",
+        **{name: float(p) for name, p in zip(CLASS_NAMES, row)},
+        "confidence": float(conf),
+        "uncertain": bool(unsure),
+    } for row, is_positive, conf, unsure in zip(probabilities, positive, confidence, uncertain)]
+
+def classify_batch(input_data, session, threshold=None):
+    return label_scores(score_batch(input_data, session), threshold)
+
+def score_images_onnx(images, session, max_batch_size=MAX_BATCH_SIZE, progress=None):
+    with timed("classify", images=len(images)):
+        return _score_images_onnx(images, session, max_batch_size, progress)
+
+def _score_images_onnx(images, session, max_batch_size, progress):
+    mode = model_mode(session)
+    batch_size = max(1, model_batch_limit(session, max_batch_size))
+
+    channels = 1 if mode == "L" else 3
+    buffer = np.empty((min(batch_size, len(images)), channels, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+
+    probabilities = np.empty((len(images), len(CLASS_NAMES)), dtype=np.float32)
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        input_data = buffer[:len(chunk)]
+        for slot, image in zip(input_data, chunk):
+            # Image.open is lazy, so conversion is where the pixels get decoded
+            with timed("decode"):
+                image = image.convert(mode)
+            preprocess_image(image, out=slot)
+        probabilities[start:start + len(chunk)] = score_batch(input_data, session)
+        if progress is not None:
+            progress(start + len(chunk), len(images))
+    return probabilities
+
+def classify_images_onnx(images, session, max_batch_size=MAX_BATCH_SIZE, progress=None, threshold=None):
+    return label_scores(score_images_onnx(images, session, max_batch_size, progress), threshold)
+
+def classify_image_onnx(image, session, threshold=None):
+    return classify_images_onnx([image], session, threshold=threshold)[0]["prediction"]
+
+def decode_for_tiles(image, mode, grid):
+    # The tiles never need more than grid * IMAGE_SIZE pixels per side, so JPEGs are
+    # decoded at a reduced DCT scale and anything still far larger is box-reduced
+    target = grid * IMAGE_SIZE
+    if isinstance(image, DicomImage):
+        return decode_dicom(image, target).convert(mode)
+    try:
+        image.draft(mode, (target, target))
+        factor = min(image.width, image.height) // target
+        if factor >= 2:
+            image = image.reduce(factor)
+        return image.convert(mode)
+    except DECODE_ERRORS as e:
+        raise ImageRejected(f"could not decode image: {e}") from e
+
+def tile_boxes(width, height, grid, overlap):
+    tile_width = width / (grid - (grid - 1) * overlap)
+    tile_height = height / (grid - (grid - 1) * overlap)
+    boxes = []
+    for row in range(grid):
+        for col in range(grid):
+            left = col * tile_width * (1 - overlap)
+            top = row * tile_height * (1 - overlap)
+            boxes.append((round(left), round(top),
+                          min(width, round(left + tile_width)), min(height, round(top + tile_height))))
+    return boxes
+
+def classify_tiled(image, session, grid=TILE_GRID, overlap=TILE_OVERLAP, aggregate=TILE_AGGREGATE, threshold=None):
+    with timed("decode", tiled=True):
+        image = decode_for_tiles(image, model_mode(session), grid)
+    tiles = [image.crop(box) for box in tile_boxes(image.width, image.height, grid, overlap)]
+    # All tiles go through one session.run unless the model has a smaller fixed batch
+    probabilities = score_images_onnx(tiles, session, max_batch_size=len(tiles))
+    if aggregate == "max":
+        film = probabilities[probabilities[:, CLASS_NAMES.index("Tuberculosis")].argmax()]
+    else:
+        film = probabilities.mean(axis=0)
+    result = label_scores(film, threshold)[0]
+    result["heatmap"] = probabilities[:, CLASS_NAMES.index("Tuberculosis")].reshape(grid, grid).tolist()
+    return result
+
+def fill_tta_views(image, buffer):
+    # Flips and intensity shifts are applied to the already-normalised plain view,
+    # so only crops need another resize
+    base = preprocess_image(image, out=buffer[0])
+    for slot, recipe in zip(buffer[1:], TTA_RECIPES[1:]):
+        kind = recipe[0]
+        if kind == "identity":
+            slot[...] = base
+        elif kind == "flip":
+            slot[...] = base[..., ::-1]
+        elif kind == "crop":
+            fraction, x, y = recipe[1:]
+            width, height = round(image.width * fraction), round(image.height * fraction)
+            left, top = round((image.width - width) * x), round((image.height - height) * y)
+            preprocess_image(image.crop((left, top, left + width, top + height)), out=slot)
+        elif kind == "shift":
+            gain, offset = recipe[1:]
+            pixels = np.clip((base * NORMALIZE_STD + NORMALIZE_MEAN) * gain + offset, 0, 1)
+            slot[...] = (pixels - NORMALIZE_MEAN) / NORMALIZE_STD
+    return buffer
+
+def classify_tta(image, session, views=TTA_VIEWS, threshold=None):
+    views = max(1, min(views, len(TTA_RECIPES)))
+    mode = model_mode(session)
+    with timed("decode"):
+        image = image.convert(mode)
+    buffer = np.empty((views, model_channels(session), IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+    with timed("tta_views", views=views):
+        fill_tta_views(image, buffer)
+    # One session.run for all views unless the model has a smaller fixed batch
+    batch_size = max(1, model_batch_limit(session, views))
+    probabilities = np.concatenate([score_batch(buffer[start:start + batch_size], session)
+                                    for start in range(0, views, batch_size)])
+    result = label_scores(probabilities.mean(axis=0), threshold)[0]
+    result["tta_std"] = float(probabilities[:, CLASS_NAMES.index("Tuberculosis")].std())
+    return result
+
+def heatmap_overlay(image, heatmap, alpha=0.4):
+    base = image.convert("RGB")
+    base.thumbnail((1024, 1024))
+    heat = Image.fromarray(np.uint8(np.asarray(heatmap) * 255), "L").resize(base.size, Image.BILINEAR)
+    blank = Image.new("L", base.size, 0)
+    return Image.blend(base, Image.merge("RGB", (heat, blank, blank)), alpha)
 
-    predicted_class = "Normal" if result[0][0] > result[0][1] else "Tuberculosis"
-    return predicted_class
+def result_cache_key(payload, digest):
+    return hashlib.sha256(payload).hexdigest() + ":" + digest
+
+def open_result_db():
+    global _results_db
+    if _results_db is None and RESULT_CACHE_PATH:
+        _results_db = sqlite3.connect(RESULT_CACHE_PATH, check_same_thread=False)
+        _results_db.execute("CREATE TABLE IF NOT EXISTS results "
+                            "(key TEXT PRIMARY KEY, result TEXT NOT NULL, last_used REAL NOT NULL)")
+        _results_db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+    return _results_db
+
+def cache_get(key):
+    with _results_lock:
+        if key in _results:
+            _results.move_to_end(key)
+            return _results[key]
+        db = open_result_db()
+        if db is None:
+            return None
+        row = db.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with db:
+            db.execute("UPDATE results SET last_used = julianday('now') WHERE key = ?", (key,))
+        result = json.loads(row[0])
+        _remember(key, result)
+        return result
+
+def cache_put(key, result):
+    with _results_lock:
+        _remember(key, result)
+        db = open_result_db()
+        if db is None:
+            return
+        with db:
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, julianday('now'))",
+                       (key, json.dumps(result)))
+            db.execute("DELETE FROM results WHERE key IN "
+                       "(SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                       (RESULT_CACHE_DISK_SIZE,))
+
+def _remember(key, result):
+    _results[key] = result
+    _results.move_to_end(key)
+    while len(_results) > RESULT_CACHE_SIZE:
+        _results.popitem(last=False)
+
+def server_request(path, payload=None):
+    request = urllib.request.Request(SERVER_URL.rstrip("/") + path, data=payload,
+                                     headers={"Content-Type": "application/octet-stream"})
+    with urllib.request.urlopen(request, timeout=SERVER_TIMEOUT) as response:
+        return json.loads(response.read())
+
+def score_payloads_remote(payloads, progress=None):
+    # One request per image, sent together so the server can micro-batch them.
+    # Images the server rejects (HTTP 400) keep NaN scores and are returned in errors.
+    probabilities = np.full((len(payloads), len(CLASS_NAMES)), np.nan, dtype=np.float32)
+    errors = {}
+    with ThreadPoolExecutor(max_workers=min(16, len(payloads))) as pool:
+        futures = {pool.submit(server_request, "/score", payload): i for i, payload in enumerate(payloads)}
+        for count, future in enumerate(as_completed(futures), 1):
+            try:
+                probabilities[futures[future]] = future.result()["probabilities"]
+            except urllib.error.HTTPError as e:
+                if e.code != 400:
+                    raise
+                errors[futures[future]] = json.loads(e.read()).get("error", str(e))
+            if progress is not None:
+                progress(count, len(payloads))
+    return probabilities, errors
+
+def classify_uploads(payloads, session, digest, progress=None, images=None):
+    # Per-class scores are cached per image content and model digest, so a new model
+    # never serves stale results and a repeat upload skips decoding and inference.
+    # The threshold is applied by the caller, so changing it never needs a rerun.
+    # Already-decoded images can be passed in to avoid decoding the payloads again.
+    # Files that fail to decode keep NaN scores, are never cached, and are returned
+    # in errors ({index: reason}) so one corrupt film doesn't fail the others.
+    errors = {}
+    with timed("cache_lookup", images=len(payloads)):
+        keys = [result_cache_key(payload, digest) for payload in payloads]
+        cached = [cache_get(key) for key in keys]
+    probabilities = np.array([[scores[name] for name in CLASS_NAMES] if scores is not None
+                              else [np.nan] * len(CLASS_NAMES) for scores in cached], dtype=np.float32)
+    missing = [i for i, scores in enumerate(cached) if scores is None]
+    if missing:
+        hits = len(payloads) - len(missing)
+        report = None if progress is None else lambda count, total: progress(hits + count, len(payloads))
+        if session is None:
+            with timed("server_score", images=len(missing)):
+                probabilities[missing], remote_errors = score_payloads_remote([payloads[i] for i in missing], report)
+            errors = {missing[j]: reason for j, reason in remote_errors.items()}
+        else:
+            mode = model_mode(session)
+            decoded, scored = [], []
+            with timed("decode_upload", images=len(missing)):
+                for i in missing:
+                    try:
+                        decoded.append(images[i] if images is not None else decode_reduced(open_upload(payloads[i]), mode))
+                        scored.append(i)
+                    except ImageRejected as e:
+                        errors[i] = str(e)
+            if decoded:
+                probabilities[scored] = score_images_onnx(decoded, session, progress=report)
+        for i in missing:
+            if i not in errors:
+                cache_put(keys[i], {name: float(p) for name, p in zip(CLASS_NAMES, probabilities[i])})
+    return probabilities, errors
+
+def classify_in_background(uploaded_files, session, digest, threshold=None, images=None):
+    # A rerun for the same uploads reattaches to the running job instead of starting another
+    key = tuple(uploaded_file.file_id for uploaded_file in uploaded_files)
+    job = st.session_state.get("classification")
+    if job is None or job["key"] != key:
+        done = {"count": 0}
+        payloads = [uploaded_file.getvalue() for uploaded_file in uploaded_files]
+        # The worker records into its own span list, which any rerun showing this job can merge
+        worker_spans = []
+        context = contextvars.copy_context()
+        context.run(_span_sink.set, worker_spans)
+        future = _executor.submit(context.run, classify_uploads, payloads, session, digest,
+                                  lambda count, total: done.update(count=count), images)
+        job = {"key": key, "done": done, "future": future, "spans": worker_spans}
+        st.session_state["classification"] = job
+
+    total = len(uploaded_files)
+    bar = st.progress(0.0, text="Classifying...")
+    with timed("wait_for_result"):
+        while not job["future"].done():
+            count = job["done"]["count"]
+            bar.progress(count / total, text=f"Classifying... {count}/{total}")
+            wait([job["future"]], timeout=0.1)
+    bar.empty()
+    spans = _span_sink.get()
+    if spans is not None:
+        spans.extend(job["spans"])
+    if job["future"].exception() is not None:
+        # Dropped so the next rerun starts a fresh job instead of re-raising this one
+        del st.session_state["classification"]
+        error = job["future"].exception()
+        st.error(f"Classification failed: {type(error).__name__}: {error}")
+        st.stop()
+    probabilities, errors = job["future"].result()
+    results = label_scores(probabilities, threshold)
+    for i, reason in errors.items():
+        results[i].update(prediction="Rejected", uncertain=False, error=reason)
+    return results
+
+def run_in_background(message, fn, *args, **kwargs):
+    context = contextvars.copy_context()
+    with st.spinner(message):
+        return _executor.submit(context.run, fn, *args, **kwargs).result()
+
+def classify_tiled_in_background(uploaded_file, session, threshold=None):
+    # Opened fresh on the worker so draft() can act before any pixels are decoded
+    payload = uploaded_file.getvalue()
+    return run_in_background(f"Classifying {TILE_GRID}x{TILE_GRID} tiles...",
+                             lambda: classify_tiled(open_upload(payload), session, threshold=threshold))
+
+def profile_classification(payloads, model_path):
+    # A one-off session with profiling on, so the shared sessions never pay for it
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    options = create_session_options(INTRA_OP_THREADS, INTER_OP_THREADS, GRAPH_OPT_LEVEL)
+    options.enable_profiling = True
+    options.profile_file_prefix = os.path.join(PROFILE_DIR, "tb_profile")
+    session = onnxruntime.InferenceSession(resolve_model_path(model_path), sess_options=options,
+                                           providers=["CPUExecutionProvider"])
+    # Decoded the same way classify_uploads does, so DICOM uploads profile too
+    images = []
+    for payload in payloads:
+        try:
+            images.append(decode_reduced(open_upload(payload), model_mode(session)))
+        except ImageRejected:
+            continue
+    if images:
+        score_images_onnx(images, session)
+    return session.end_profiling()
+
+def show_debug_panel(spans, uploaded_files):
+    with st.expander("Timing debug panel", expanded=True):
+        if spans:
+            table = pd.DataFrame(spans)
+            st.dataframe(table.groupby("stage", sort=False)["ms"].agg(["count", "sum", "mean", "max"]))
+            st.dataframe(table)
+
+        if uploaded_files and not SERVER_URL and st.button("Run onnxruntime profiler on these uploads"):
+            profile_path = profile_classification([uploaded_file.getvalue() for uploaded_file in uploaded_files],
+                                                  MODEL_PATH)
+            with open(profile_path) as f:
+                trace = f.read()
+            nodes = [event for event in json.loads(trace) if event.get("cat") == "Node"]
+            if nodes:
+                ops = pd.DataFrame([{"node": e["name"], "op": e.get("args", {}).get("op_name"), "us": e["dur"]}
+                                    for e in nodes])
+                st.write("Slowest operators")
+                st.dataframe(ops.groupby(["op"])["us"].sum().sort_values(ascending=False).head(20))
+            st.download_button("Download profile (chrome://tracing)", trace,
+                               file_name=os.path.basename(profile_path), mime="application/json")
 
 def main():
+    spans = start_spans()
+    started = time.perf_counter()
+    debug = st.sidebar.checkbox("Show timing debug panel")
+    threshold = st.sidebar.slider("Tuberculosis decision threshold", 0.05, 0.95, DECISION_THRESHOLD, 0.01)
+    # Tiling needs the model in this process, so it is off when using the inference server
+    tiled = not SERVER_URL and st.sidebar.checkbox("Tiled high-resolution mode (single image)")
+    tta = not SERVER_URL and not tiled and st.sidebar.checkbox("Test-time augmentation (single image)")
+
     st.title('Upload Lung X-ray image')
+    # Loaded (and warmed up) once per process, before the first upload arrives
+    with timed("load_model"):
+        if SERVER_URL:
+            session = None
+            try:
+                digest = server_request("/info")["digest"]
+            except OSError as e:
+                # URLError, HTTPError and timeouts are all OSErrors
+                st.error(f"The inference server at {SERVER_URL} is unreachable ({e}). "
+                         "Start tb_server.py or unset TB_SERVER_URL.")
+                st.stop()
+        else:
+            session = load_onnx_model(MODEL_PATH)
+            digest = model_digest(resolve_model_path(MODEL_PATH))
 
     
-    uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
-    time.sleep(2)
-    if uploaded_file is not None:
-        onnx_model_path = "resnet.onnx"
-        session = load_onnx_model(onnx_model_path)
+    uploaded_files = st.file_uploader("Choose an image...", type=UPLOAD_TYPES,
+                                      accept_multiple_files=True)
+    # Reject oversized or unreadable files from their headers before decoding anything
+    accepted = []
+    for uploaded_file in uploaded_files:
+        try:
+            accepted.append((uploaded_file, open_upload(uploaded_file.getvalue())))
+        except ImageRejected as e:
+            st.error(f"{uploaded_file.name} was rejected: {e}")
+    uploaded_files = [uploaded_file for uploaded_file, _ in accepted]
 
-        image = Image.open(uploaded_file)
-        st.image(image, caption='Uploaded Image', use_column_width=True)
+    if len(uploaded_files) > 1:
+        results = classify_in_background(uploaded_files, session, digest, threshold)
+        table = pd.DataFrame(results)
+        table.insert(0, "file", [uploaded_file.name for uploaded_file in uploaded_files])
+        rejected = int((table["prediction"] == "Rejected").sum())
+        st.write(f"Classified {len(table) - rejected} images, {int(table['uncertain'].sum())} in the uncertain band"
+                 + (f"; {rejected} could not be decoded" if rejected else ""))
+        st.dataframe(table.sort_values("Tuberculosis", ascending=False))
+    elif uploaded_files:
+        uploaded_file, image = accepted[0]
+        with timed("decode_upload"):
+            try:
+                image = decode_reduced(image, "L" if session is None else model_mode(session))
+            except ImageRejected as e:
+                st.error(f"{uploaded_file.name} was rejected: {e}")
+                st.stop()
+        with timed("preview"):
+            st.image(image, caption='Uploaded Image', use_column_width=True)
 
-        predicted_class = classify_image_onnx(image, session)
+        if tiled:
+            try:
+                result = classify_tiled_in_background(uploaded_file, session, threshold)
+            except ImageRejected as e:
+                st.error(f"{uploaded_file.name} was rejected: {e}")
+                st.stop()
+            st.image(heatmap_overlay(image, result["heatmap"]),
+                     caption="Tile heatmap (red = higher tuberculosis probability)", use_column_width=True)
+        elif tta:
+            result = run_in_background(f"Classifying {TTA_VIEWS} augmented views...",
+                                       classify_tta, image, session, threshold=threshold)
+        else:
+            result = classify_in_background(uploaded_files, session, digest, threshold, [image])[0]
+            if "error" in result:
+                st.error(f"{uploaded_file.name} was rejected: {result['error']}")
+                st.stop()
+        predicted_class = result["prediction"]
+        st.write(f"Tuberculosis probability: {result['Tuberculosis']:.1%}")
+        if tta:
+            st.write(f"Spread across augmented views: ±{result['tta_std']:.1%}")
+        if result["uncertain"]:
+            st.warning("This film is close to the decision threshold; consider rescreening.")
         if predicted_class=="Tuberculosis":
            st.write("This X-ray image shows characteristic features consistent with tuberculosis (TB) infection:\n"
                     "- Areas of increased opacity and consolidation are observed, indicating inflammation and fluid accumulation in the lung tissue.\n"
@@ -69,5 +816,14 @@ def main():
               "ባህሪያዊ የቲቢ ግኝቶች አለመኖራቸውን እና ከታካሚው ክሊኒካዊ ታሪክ እና ምልክቶች ጋር በመተባበር በሽተኛው በሳንባ ነቀርሳ መያዙ አይቀርም."
               )
 
+    record_span("main", started)
+    if debug:
+        show_debug_panel(spans, uploaded_files)
+
 
-main()
+if __name__ == "__main__":
+    # Streamlit re-executes this file as __main__ on every rerun, which would rebuild the
+    # module-level state above each time. Running main from the imported module keeps
+    # that state in one place for the life of the process.
+    import normal
+    normal.main()
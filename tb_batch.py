@@ -0,0 +1,159 @@
+# Headless batch scoring for the TB classifier in normal.py
+# Run: python tb_batch.py xrays/ -o results.csv
+#      python tb_batch.py manifest.txt -o results.parquet --batch-size 32 --workers 8
+#
+# Images are decoded and preprocessed in a process pool and fed to onnxruntime in
+# batches. Every scored file is appended to a CSV checkpoint as soon as its batch
+# finishes, so an interrupted run picks up where it stopped when started again;
+# files that failed to decode are tried again on that run.
+
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import batching
+import normal
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.dcm', '.dicom'}
+FIELDS = ["path", "prediction", *normal.CLASS_NAMES, "confidence", "uncertain", "error"]
+
+def scan_inputs(source):
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield os.path.join(root, name)
+        return
+
+    # Manifest: a CSV with a "path" column, or plain text with one path per line
+    with open(source, newline='') as f:
+        if source.lower().endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield row['path']
+        else:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+
+def checkpoint_path_for(output):
+    return output if output.lower().endswith('.csv') else output + '.checkpoint.csv'
+
+def load_checkpoint(checkpoint_path):
+    # Paths already scored. Rows for files that failed to decode are dropped from the
+    # checkpoint so they are retried: a half-copied file or a network hiccup is not final
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    scored = [row for row in rows if not row.get('error')]
+    if len(scored) < len(rows):
+        tmp = checkpoint_path + '.tmp'
+        with open(tmp, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(scored)
+        os.replace(tmp, checkpoint_path)
+    return {row['path'] for row in scored}
+
+def decode(path, mode):
+    # Runs in a worker process; failures are reported per file instead of stopping the job
+    try:
+        # DICOM files are opened header-only and their pixels memory-mapped where possible
+        image = normal.open_image_file(path)
+        normal.check_image(image, os.path.getsize(path))
+        return path, normal.preprocess_image(normal.decode_reduced(image, mode)), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+def score(paths, session, checkpoint_path, batch_size, workers, queue_depth, threshold=None):
+    mode = normal.model_mode(session)
+    batch_size = max(1, normal.model_batch_limit(session, batch_size))
+    write_header = not os.path.exists(checkpoint_path) or os.path.getsize(checkpoint_path) == 0
+
+    scored = 0
+    started = time.perf_counter()
+    # Spawned workers don't inherit onnxruntime's thread pools from this process
+    context = multiprocessing.get_context("spawn")
+    with open(checkpoint_path, 'a', newline='') as out, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        writer = csv.DictWriter(out, fieldnames=FIELDS)
+        if write_header:
+            writer.writeheader()
+
+        batch_paths, batch = [], []
+
+        def flush():
+            nonlocal scored
+            results = normal.classify_batch(np.stack(batch), session, threshold)
+            for path, result in zip(batch_paths, results):
+                writer.writerow({"path": path, **result})
+            out.flush()
+            scored += len(batch)
+            batch_paths.clear()
+            batch.clear()
+            elapsed = time.perf_counter() - started
+            print(f"\rScored {scored} images ({scored / elapsed:.1f} img/s)", end='', file=sys.stderr)
+
+        # Keep at most queue_depth decodes in flight so memory stays bounded
+        for path, array, error in batching.bounded_results(pool, decode, ((path, mode) for path in paths),
+                                                           queue_depth):
+            if error is not None:
+                writer.writerow({"path": path, "error": error})
+                continue
+            batch_paths.append(path)
+            batch.append(array)
+            if len(batch) == batch_size:
+                flush()
+        if batch:
+            flush()
+    if scored:
+        print(file=sys.stderr)
+    return scored
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score X-ray images with the TB classifier")
+    parser.add_argument("source", help="directory of images, or a manifest (.csv with a 'path' column, or one path per line)")
+    parser.add_argument("-o", "--output", required=True, help="results file (.csv or .parquet)")
+    parser.add_argument("--model", default=normal.MODEL_PATH)
+    parser.add_argument("--variant", choices=normal.MODEL_VARIANTS, default=None,
+                        help="model build to use (default: TB_MODEL_VARIANT or fp32)")
+    parser.add_argument("--batch-size", type=int, default=normal.MAX_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--queue-depth", type=int, default=None,
+                        help="max images decoded ahead of inference (default: 4 batches)")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="Tuberculosis probability threshold (default: TB_THRESHOLD or 0.5)")
+    parser.add_argument("--intra-op-threads", type=int, default=None)
+    parser.add_argument("--inter-op-threads", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    checkpoint_path = checkpoint_path_for(args.output)
+    done = load_checkpoint(checkpoint_path)
+    paths = (path for path in scan_inputs(args.source) if path not in done)
+    if done:
+        print(f"Resuming: {len(done)} files already scored", file=sys.stderr)
+
+    session = normal.load_onnx_model(args.model, args.intra_op_threads, args.inter_op_threads,
+                                     variant=args.variant)
+    queue_depth = args.queue_depth or 4 * args.batch_size
+    started = time.perf_counter()
+    scored = score(paths, session, checkpoint_path, args.batch_size, args.workers, queue_depth,
+                   args.threshold)
+    elapsed = time.perf_counter() - started
+    print(f"Scored {scored} new images in {elapsed:.1f}s", file=sys.stderr)
+
+    if checkpoint_path != args.output:
+        # The checkpoint is kept so later runs over a growing directory only score new files
+        pd.read_csv(checkpoint_path).to_parquet(args.output, index=False)
+        print(f"Wrote {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# Latency and throughput benchmark for the TB classifier in normal.py
+# Run: python tb_bench.py -o bench.json
+#      python tb_bench.py --stand-in --batch-sizes 1,8,32 --threads 1,4
+#
+# Per-stage latency (decode, convert, preprocess, session.run) is measured on
+# synthetic grayscale and RGB images of several sizes; throughput is measured
+# for each batch size and intra-op thread count. Results are emitted as JSON so
+# runs can be diffed between releases. --stand-in generates a small ONNX model
+# with the same input/output contract, for machines without resnet.onnx.
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import onnxruntime
+from PIL import Image
+
+import normal
+
+IMAGE_SIZES = [256, 512, 1024, 2048]
+IMAGE_MODES = ["L", "RGB"]
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+    }
+
+def write_stand_in_model(path, channels=1):
+    # Conv -> ReLU -> global pool -> 2-way linear, with a dynamic batch dimension
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    rng = np.random.default_rng(0)
+    weights = [
+        numpy_helper.from_array(rng.standard_normal((16, channels, 7, 7)).astype(np.float32) * 0.1, "conv_w"),
+        numpy_helper.from_array(np.zeros(16, np.float32), "conv_b"),
+        numpy_helper.from_array(rng.standard_normal((2, 16)).astype(np.float32), "fc_w"),
+        numpy_helper.from_array(np.zeros(2, np.float32), "fc_b"),
+    ]
+    nodes = [
+        helper.make_node("Conv", ["input", "conv_w", "conv_b"], ["conv"], strides=[4, 4], pads=[3, 3, 3, 3]),
+        helper.make_node("Relu", ["conv"], ["relu"]),
+        helper.make_node("GlobalAveragePool", ["relu"], ["pool"]),
+        helper.make_node("Flatten", ["pool"], ["flat"]),
+        helper.make_node("Gemm", ["flat", "fc_w", "fc_b"], ["output"], transB=1),
+    ]
+    graph = helper.make_graph(
+        nodes, "tb_stand_in",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["batch", channels, normal.IMAGE_SIZE, normal.IMAGE_SIZE])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", 2])],
+        weights,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+def synthetic_png(size, mode, rng):
+    shape = (size, size) if mode == "L" else (size, size, 3)
+    buf = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, shape, dtype=np.uint8), mode).save(buf, "PNG")
+    return buf.getvalue()
+
+def bench_latency(session, repeats, rng):
+    mode = normal.model_mode(session)
+    input_name = session.get_inputs()[0].name
+    buffer = np.empty((1, normal.model_channels(session), normal.IMAGE_SIZE, normal.IMAGE_SIZE), dtype=np.float32)
+
+    report = {}
+    for source_mode in IMAGE_MODES:
+        for size in IMAGE_SIZES:
+            payload = synthetic_png(size, source_mode, rng)
+            stages = {"decode": [], "convert": [], "preprocess": [], "run": []}
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                image = Image.open(io.BytesIO(payload))
+                image.load()
+                t1 = time.perf_counter()
+                image = image.convert(mode)
+                t2 = time.perf_counter()
+                normal.preprocess_image(image, out=buffer[0])
+                t3 = time.perf_counter()
+                session.run(None, {input_name: buffer})
+                t4 = time.perf_counter()
+                stages["decode"].append(t1 - t0)
+                stages["convert"].append(t2 - t1)
+                stages["preprocess"].append(t3 - t2)
+                stages["run"].append(t4 - t3)
+            report[f"{source_mode}-{size}x{size}"] = {stage: percentiles(samples) for stage, samples in stages.items()}
+    return report
+
+def bench_throughput(model_path, thread_counts, batch_sizes, repeats, rng):
+    report = []
+    for threads in thread_counts:
+        session = normal.load_onnx_model(model_path, intra_op_threads=threads, variant="fp32")
+        input_name = session.get_inputs()[0].name
+        shape = (normal.model_channels(session), normal.IMAGE_SIZE, normal.IMAGE_SIZE)
+        for batch_size in batch_sizes:
+            if normal.model_batch_limit(session, batch_size) < batch_size:
+                continue
+            batch = rng.standard_normal((batch_size, *shape), dtype=np.float32)
+            session.run(None, {input_name: batch})
+            samples = []
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                session.run(None, {input_name: batch})
+                samples.append(time.perf_counter() - t0)
+            report.append({
+                "intra_op_threads": threads,
+                "batch_size": batch_size,
+                "images_per_sec": round(batch_size * len(samples) / sum(samples), 2),
+                **percentiles(samples),
+            })
+            print(f"threads={threads} batch={batch_size}: {report[-1]['images_per_sec']} img/s", file=sys.stderr)
+    return report
+
+def parse_ints(value):
+    return [int(v) for v in value.split(',') if v]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark TB classifier latency and throughput")
+    parser.add_argument("--model", default=normal.MODEL_PATH)
+    parser.add_argument("--stand-in", action="store_true", help="benchmark a generated stand-in model instead of --model")
+    parser.add_argument("--channels", type=int, default=1, help="input channels of the stand-in model")
+    parser.add_argument("--batch-sizes", type=parse_ints, default=BATCH_SIZES)
+    parser.add_argument("--threads", type=parse_ints, default=[1, 2, 4, 0],
+                        help="intra-op thread counts to sweep (0 = onnxruntime default)")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model
+        if args.stand_in:
+            model_path = os.path.join(tmp, "stand_in.onnx")
+            write_stand_in_model(model_path, args.channels)
+
+        # --model is taken literally; pass e.g. resnet.int8.onnx to benchmark a variant
+        session = normal.load_onnx_model(model_path, variant="fp32")
+        report = {
+            "model": "stand-in" if args.stand_in else args.model,
+            "model_digest": normal.model_digest(model_path),
+            "onnxruntime": onnxruntime.__version__,
+            "numpy": np.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "repeats": args.repeats,
+            "latency": bench_latency(session, args.repeats, rng),
+            "throughput": bench_throughput(model_path, args.threads, args.batch_sizes, args.repeats, rng),
+        }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# Build and validate reduced-precision variants of the TB classifier
+# Run: python tb_quantize.py build int8
+#      python tb_quantize.py build int8-static --calibration calibration_xrays/
+#      python tb_quantize.py build fp16
+#      python tb_quantize.py compare int8 --images validation_xrays/ -o int8_report.json
+#
+# Variants are written next to the FP32 model (resnet.int8.onnx, ...) and picked
+# up by normal.load_onnx_model when TB_MODEL_VARIANT is set. `compare` runs both
+# models over a folder of images and reports prediction agreement and latency
+# (unreadable files are skipped and listed under "skipped"); it exits non-zero
+# when agreement is below --min-agreement, so a variant can be gated before it is
+# switched on.
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_dynamic, quantize_static
+
+import normal
+from tb_batch import scan_inputs
+from tb_bench import percentiles
+
+def load_input(path, mode):
+    # Same decode as the app and tb_batch, so DICOM files work too
+    return normal.preprocess_image(normal.decode_reduced(normal.open_image_file(path), mode))[np.newaxis]
+
+class ImageCalibrationReader(CalibrationDataReader):
+    # Feeds preprocessed X-rays from a local folder to the static quantizer, one at a time;
+    # unreadable files are skipped and listed in `skipped`
+    def __init__(self, folder, input_name, mode, limit):
+        self.paths = iter(list(scan_inputs(folder))[:limit])
+        self.input_name = input_name
+        self.mode = mode
+        self.skipped = []
+
+    def get_next(self):
+        for path in self.paths:
+            try:
+                return {self.input_name: load_input(path, self.mode)}
+            except (normal.ImageRejected, OSError) as e:
+                self.skipped.append({"path": path, "error": str(e)})
+        return None
+
+def build(variant, model_path, calibration=None, calibration_limit=200):
+    output = normal.variant_model_path(model_path, variant)
+    if variant == "int8":
+        quantize_dynamic(model_path, output, weight_type=QuantType.QInt8)
+    elif variant == "int8-static":
+        if not calibration:
+            raise ValueError("int8-static needs --calibration with a folder of representative X-rays")
+        session = normal.load_onnx_model(model_path, variant="fp32", warmup=False)
+        reader = ImageCalibrationReader(calibration, session.get_inputs()[0].name,
+                                        normal.model_mode(session), calibration_limit)
+        quantize_static(model_path, output, reader,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        for skipped in reader.skipped:
+            print(f"Skipped {skipped['path']}: {skipped['error']}", file=sys.stderr)
+    elif variant == "fp16":
+        import onnx
+        from onnxruntime.transformers.float16 import convert_float_to_float16
+        # Inputs and outputs stay float32 so callers don't change
+        model = convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+        onnx.save(model, output)
+    else:
+        raise ValueError(f"Cannot build variant {variant!r}")
+    return output
+
+def compare(variant, model_path, images, limit):
+    baseline = normal.load_onnx_model(model_path, variant="fp32")
+    candidate = normal.load_onnx_model(model_path, variant=variant)
+    mode = normal.model_mode(baseline)
+
+    paths = list(scan_inputs(images))[:limit]
+    if not paths:
+        raise ValueError(f"No images found in {images}")
+
+    agree = 0
+    tb_diffs = []
+    timings = {"fp32": [], variant: []}
+    disagreements = []
+    skipped = []
+    for path in paths:
+        try:
+            input_data = load_input(path, mode)
+        except (normal.ImageRejected, OSError) as e:
+            skipped.append({"path": path, "error": str(e)})
+            continue
+        results = {}
+        for name, session in (("fp32", baseline), (variant, candidate)):
+            t0 = time.perf_counter()
+            results[name] = normal.classify_batch(input_data, session)[0]
+            timings[name].append(time.perf_counter() - t0)
+        if results["fp32"]["prediction"] == results[variant]["prediction"]:
+            agree += 1
+        else:
+            disagreements.append(path)
+        tb_diffs.append(abs(results["fp32"]["Tuberculosis"] - results[variant]["Tuberculosis"]))
+    if not tb_diffs:
+        raise ValueError(f"None of the {len(paths)} images in {images} could be read")
+
+    return {
+        "variant": variant,
+        "fp32_model": model_path,
+        "fp32_digest": normal.model_digest(model_path),
+        "variant_model": normal.variant_model_path(model_path, variant),
+        "variant_digest": normal.model_digest(normal.variant_model_path(model_path, variant)),
+        "images": len(tb_diffs),
+        "agreement": agree / len(tb_diffs),
+        "tuberculosis_prob_abs_diff_mean": float(np.mean(tb_diffs)),
+        "tuberculosis_prob_abs_diff_max": float(np.max(tb_diffs)),
+        "latency": {name: percentiles(samples) for name, samples in timings.items()},
+        "disagreements": disagreements,
+        "skipped": skipped,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and validate quantized TB classifier variants")
+    parser.add_argument("--model", default=normal.MODEL_PATH, help="FP32 model the variants derive from")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="write a quantized or FP16 variant of the model")
+    build_parser.add_argument("variant", choices=[v for v in normal.MODEL_VARIANTS if v != "fp32"])
+    build_parser.add_argument("--calibration", help="folder of images for int8-static calibration")
+    build_parser.add_argument("--calibration-limit", type=int, default=200)
+
+    compare_parser = commands.add_parser("compare", help="check a variant's predictions against FP32")
+    compare_parser.add_argument("variant", choices=[v for v in normal.MODEL_VARIANTS if v != "fp32"])
+    compare_parser.add_argument("--images", required=True, help="folder of validation images")
+    compare_parser.add_argument("--limit", type=int, default=1000)
+    compare_parser.add_argument("--min-agreement", type=float, default=0.99)
+    compare_parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        output = build(args.variant, args.model, args.calibration, args.calibration_limit)
+        print(f"Wrote {output}", file=sys.stderr)
+        return
+
+    report = compare(args.variant, args.model, args.images, args.limit)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if report["agreement"] < args.min_agreement:
+        print(f"Agreement {report['agreement']:.4f} is below {args.min_agreement}; keep serving FP32",
+              file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# Local inference server for the TB classifier
+# Run: python tb_server.py --port 8502
+#      TB_SERVER_URL=http://127.0.0.1:8502 streamlit run normal.py
+#
+# One process holds the onnxruntime session for any number of Streamlit sessions
+# (or processes) pointed at it with TB_SERVER_URL. Each POST /score carries one
+# encoded image; handler threads decode and preprocess in parallel, and a single
+# batcher thread groups requests that arrive within --max-wait-ms of each other
+# into one session.run.
+
+import argparse
+import json
+import queue
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import batching
+import normal
+
+class MicroBatcher:
+    def __init__(self, session, max_batch_size, max_wait_ms):
+        self.session = session
+        self.max_batch_size = max(1, normal.model_batch_limit(session, max_batch_size))
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, name="tb-batcher", daemon=True).start()
+
+    def submit(self, tensor):
+        request = {"tensor": tensor, "done": threading.Event()}
+        self.queue.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["probabilities"]
+
+    def _run(self):
+        while True:
+            batch = batching.next_batch(self.queue, self.max_batch_size, self.max_wait)
+            try:
+                probabilities = normal.score_batch(np.stack([r["tensor"] for r in batch]), self.session)
+                for request, row in zip(batch, probabilities):
+                    request["probabilities"] = row.tolist()
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            for request in batch:
+                request["done"].set()
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/info":
+            self.send_json(200, self.server.info)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self.send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > normal.MAX_UPLOAD_BYTES:
+            self.send_json(413, {"error": f"upload of {length} bytes exceeds {normal.MAX_UPLOAD_BYTES}"})
+            return
+        payload = self.rfile.read(length)
+        try:
+            image = normal.decode_reduced(normal.open_upload(payload), self.server.mode)
+            tensor = normal.preprocess_image(image)
+        except normal.ImageRejected as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        try:
+            probabilities = self.server.batcher.submit(tensor)
+        except Exception as e:
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, {"probabilities": probabilities})
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(host, port, session, digest, max_batch_size, max_wait_ms):
+    server = ThreadingHTTPServer((host, port), ScoreHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(session, max_batch_size, max_wait_ms)
+    server.mode = normal.model_mode(session)
+    server.info = {"digest": digest, "classes": normal.CLASS_NAMES, "max_batch_size": server.batcher.max_batch_size}
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the TB classifier over localhost HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--model", default=normal.MODEL_PATH)
+    parser.add_argument("--variant", choices=normal.MODEL_VARIANTS, default=None)
+    parser.add_argument("--max-batch-size", type=int, default=normal.MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0,
+                        help="how long the first request in a batch waits for others to join")
+    args = parser.parse_args(argv)
+
+    session = normal.load_onnx_model(args.model, variant=args.variant)
+    digest = normal.model_digest(normal.resolve_model_path(args.model, args.variant))
+    server = make_server(args.host, args.port, session, digest, args.max_batch_size, args.max_wait_ms)
+    print(f"Serving {args.model} on http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
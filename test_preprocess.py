@@ -0,0 +1,34 @@
+# Parity between normal.preprocess_image and the torchvision pipeline the model was trained with
+# Run: python -m pytest -q test_preprocess.py
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import normal
+
+transforms = pytest.importorskip("torchvision.transforms")
+
+TOLERANCE = 1e-5
+
+def torchvision_reference(image):
+    transform = transforms.Compose([
+        transforms.Resize((normal.IMAGE_SIZE, normal.IMAGE_SIZE)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[normal.NORMALIZE_MEAN], std=[normal.NORMALIZE_STD])
+    ])
+    return transform(image).numpy()
+
+@pytest.mark.parametrize("mode", ["L", "RGB"])
+@pytest.mark.parametrize("size", [(300, 200), (512, 512), (1024, 768)])
+def test_preprocess_matches_torchvision(mode, size):
+    rng = np.random.default_rng(0)
+    shape = size[::-1] if mode == "L" else (*size[::-1], 3)
+    image = Image.fromarray(rng.integers(0, 256, shape, dtype=np.uint8), mode)
+
+    ours = normal.preprocess_image(image)
+    reference = torchvision_reference(image)
+
+    assert ours.shape == reference.shape
+    assert ours.dtype == np.float32
+    assert float(np.abs(ours - reference).max()) <= TOLERANCE